@@ -0,0 +1,129 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Copyright Tor Vergata, University of Rome. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Throughput benchmark of the GAN-BERT input pipelines
+#
+# The bundled QC files are converted to features in every --record_format of
+# ganbert.py, then batches are drawn from the TFRecord files through
+# `file_based_input_fn_builder` and from the memory-mapped NumPy feature store
+# through `feature_store.input_fn_builder`. For each format the benchmark
+# reports the conversion time, the size on disk and the batches/sec of the
+# training and eval pipelines.
+#
+#   python benchmark_input_pipeline.py --vocab_file=vocab.txt \
+#       --output_dir=/tmp/input_pipeline_benchmark --max_seq_length=64
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import os
+import time
+import tensorflow as tf
+import ganbert
+import tokenization
+from data_processors import QcTsvProcessor
+
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    "num_batches", 1000,
+    "Number of batches drawn from every training pipeline. Eval pipelines "
+    "stop at the end of the data.")
+
+DEFAULT_DATA_DIR = "data"
+
+RECORD_FORMATS = ["padded", "compact", "npy"]
+
+
+def get_size_on_disk(paths):
+  """Total size of the given files and of the files in the given dirs."""
+  size = 0
+  for path in paths:
+    if tf.gfile.IsDirectory(path):
+      size += sum(tf.gfile.Stat(os.path.join(path, name)).length
+                  for name in tf.gfile.ListDirectory(path))
+    else:
+      size += tf.gfile.Stat(path).length
+  return size
+
+
+def time_pipeline(input_fn, batch_size, num_batches):
+  """Returns the batches/sec of drawing `num_batches` from `input_fn`.
+
+  The batches are consumed inside the graph, by a single `Dataset.reduce`, so
+  that the per-step overhead of `Session.run` does not hide the pipeline.
+  """
+  with tf.Graph().as_default():
+    dataset = input_fn({"batch_size": batch_size})
+    num_drawn = dataset.take(num_batches).reduce(
+        tf.constant(0, dtype=tf.int64), lambda count, _: count + 1)
+    with tf.Session() as session:
+      start = time.time()
+      num_drawn = session.run(num_drawn)
+      elapsed = max(time.time() - start, 1e-9)
+  return num_drawn / elapsed
+
+
+def benchmark_format(record_format, labeled_examples, unlabeled_examples,
+                     label_list, tokenizer):
+  """Converts the examples with `record_format` and times its pipelines."""
+  output_dir = os.path.join(FLAGS.output_dir, record_format)
+  tf.gfile.MakeDirs(output_dir)
+  output_file = os.path.join(output_dir, "train.tf_record")
+
+  start = time.time()
+  ganbert.file_based_convert_examples_to_features(
+      labeled_examples, unlabeled_examples, label_list, FLAGS.max_seq_length,
+      tokenizer, output_file, label_mask_rate=1,
+      record_format=record_format)
+  convert_time = time.time() - start
+
+  results = collections.OrderedDict()
+  results["convert_sec"] = convert_time
+  results["disk_mib"] = get_size_on_disk(
+      ganbert.read_record_files(output_file)) / float(1 << 20)
+  for is_training in [True, False]:
+    input_fn = ganbert.manifest_input_fn_builder(
+        output_file=output_file,
+        seq_length=FLAGS.max_seq_length,
+        is_training=is_training,
+        drop_remainder=is_training)
+    results["train" if is_training else "eval"] = time_pipeline(
+        input_fn, FLAGS.train_batch_size, FLAGS.num_batches)
+  return results
+
+
+def main(_):
+  data_dir = FLAGS.data_dir or DEFAULT_DATA_DIR
+  processor = QcTsvProcessor()
+  labeled_examples = processor.get_labeled_examples(data_dir)
+  unlabeled_examples = processor.get_unlabeled_examples(data_dir)
+  label_list = processor.get_labels()
+  tokenizer = tokenization.FullTokenizer(
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case,
+      cache_size=FLAGS.tokenizer_cache_size)
+
+  print("%d examples, max_seq_length=%d, batch_size=%d" %
+        (len(labeled_examples) + len(unlabeled_examples),
+         FLAGS.max_seq_length, FLAGS.train_batch_size))
+  print("%-8s %12s %10s %14s %14s" %
+        ("format", "convert (s)", "disk (MiB)", "train batch/s",
+         "eval batch/s"))
+  for record_format in RECORD_FORMATS:
+    results = benchmark_format(record_format, labeled_examples,
+                               unlabeled_examples, label_list, tokenizer)
+    print("%-8s %12.2f %10.2f %14.1f %14.1f" %
+          (record_format, results["convert_sec"], results["disk_mib"],
+           results["train"], results["eval"]))
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("vocab_file")
+  flags.mark_flag_as_required("output_dir")
+  tf.app.run()
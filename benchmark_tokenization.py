@@ -0,0 +1,312 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Copyright Tor Vergata, University of Rome. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Throughput benchmark and regression check for the tokenizers in
+# tokenization.py
+#
+# Every tokenizer is run over the bundled QC files and over synthetic stress
+# inputs. For each pair the benchmark reports tokens/sec, words/sec, the peak
+# memory allocated while tokenizing and a fingerprint of the produced tokens.
+#
+# Record a baseline:
+#   python benchmark_tokenization.py --vocab_file=vocab.txt \
+#       --baseline_file=tokenization_baseline.json --save_baseline
+#
+# Check a change against it (exits with status 1 on a regression, or when the
+# baseline is missing or was recorded with another vocabulary or casing):
+#   python benchmark_tokenization.py --vocab_file=vocab.txt \
+#       --baseline_file=tokenization_baseline.json
+#
+# No baseline is committed: the fingerprints depend on the vocabulary, which
+# is not part of the repository, so record one before changing tokenization.py.
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import random
+import time
+import six
+import tensorflow as tf
+import tokenization
+
+try:
+  import tracemalloc
+except ImportError:
+  # Python 2 has no tracemalloc: peak memory is not measured.
+  tracemalloc = None
+
+flags = tf.flags
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    "data_dir", "data",
+    "Directory containing the bundled labeled.tsv, unlabeled.tsv and "
+    "test.tsv files.")
+
+flags.DEFINE_string("vocab_file", None,
+                    "The vocabulary file that the BERT model was trained on.")
+
+flags.DEFINE_bool(
+    "do_lower_case", True,
+    "Whether to lower case the input text.")
+
+flags.DEFINE_integer(
+    "num_repeats", 5,
+    "Number of timed runs per measurement. The fastest run is reported.")
+
+flags.DEFINE_string(
+    "baseline_file", None,
+    "JSON file with the results of a previous run. Results are compared "
+    "against it, or written to it with --save_baseline.")
+
+flags.DEFINE_bool(
+    "save_baseline", False,
+    "Whether to write the results to --baseline_file instead of checking "
+    "them against it.")
+
+flags.DEFINE_float(
+    "max_slowdown", 0.25,
+    "Largest tolerated drop in tokens/sec with respect to the baseline, "
+    "as a fraction. Any change of the produced tokens is always an error.")
+
+DATA_FILES = ["labeled.tsv", "unlabeled.tsv", "test.tsv"]
+
+# Seed of the synthetic stress inputs, so that their fingerprints are stable.
+STRESS_SEED = 0
+
+NUM_STRESS_TEXTS = 2000
+
+# Key of the baseline entry identifying the vocabulary and casing it was
+# recorded with.
+CONFIG_KEY = "config"
+
+BenchmarkResult = collections.namedtuple(
+    "BenchmarkResult",
+    ["tokens_per_sec", "words_per_sec", "peak_memory_bytes", "fingerprint"])
+
+
+def read_texts(data_dir):
+  """Reads the question texts of the bundled QC files.
+
+  Each line is "<coarse>:<fine> <question>" and the first line is a header.
+  """
+  texts = []
+  for file_name in DATA_FILES:
+    with tf.gfile.GFile(os.path.join(data_dir, file_name), "r") as reader:
+      for line in reader.read().splitlines()[1:]:
+        split = line.split(" ", 1)
+        if len(split) == 2:
+          texts.append(tokenization.convert_to_unicode(split[1]))
+  return texts
+
+
+def make_stress_texts():
+  """Returns synthetic inputs exercising the slow paths of the tokenizers."""
+  rng = random.Random(STRESS_SEED)
+
+  def random_text(alphabet, min_word, max_word, num_words):
+    return u" ".join(
+        u"".join(rng.choice(alphabet)
+                 for _ in range(rng.randint(min_word, max_word)))
+        for _ in range(num_words))
+
+  latin = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+  accented = latin + u"\u00e0\u00e1\u00e2\u00e4\u00e7\u00e8\u00e9\u00ea" \
+      u"\u00eb\u00ee\u00ef\u00f1\u00f4\u00f6\u00f9\u00fb\u00fc\u00c9" \
+      u"e\u0301a\u0300"
+  cjk = latin + u"".join(six.unichr(cp) for cp in range(0x4E00, 0x4F00))
+  controls = latin + u"\x00\x01\x07\x1b\x7f\u200b\u200e\ufeff\ufffd" \
+      u"\t\r\n\u00a0\u3000"
+
+  return collections.OrderedDict([
+      ("long_words", [random_text(latin + u"./:_-", 50, 190, 5)
+                      for _ in range(NUM_STRESS_TEXTS)]),
+      ("accented", [random_text(accented, 2, 12, 20)
+                    for _ in range(NUM_STRESS_TEXTS)]),
+      ("cjk", [random_text(cjk, 1, 8, 20)
+               for _ in range(NUM_STRESS_TEXTS)]),
+      ("control_chars", [random_text(controls, 2, 12, 20)
+                         for _ in range(NUM_STRESS_TEXTS)]),
+  ])
+
+
+def time_tokenizer(tokenize_fn, texts, num_repeats):
+  """Returns the fastest of `num_repeats` runs of `tokenize_fn` over `texts`."""
+  best = None
+  for _ in range(num_repeats):
+    start = time.time()
+    for text in texts:
+      tokenize_fn(text)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def run_benchmark(tokenize_fn, texts, num_repeats):
+  """Measures `tokenize_fn` over `texts` and returns a `BenchmarkResult`.
+
+  The peak memory is None without `tracemalloc`.
+  """
+  hasher = hashlib.sha1()
+  num_tokens = 0
+  peak_memory = None
+  if tracemalloc is not None:
+    tracemalloc.start()
+  for text in texts:
+    tokens = tokenize_fn(text)
+    num_tokens += len(tokens)
+    hasher.update(u"\n".join(tokens).encode("utf-8"))
+    hasher.update(b"\x00")
+  if tracemalloc is not None:
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+  num_words = sum(len(text.split()) for text in texts)
+  elapsed = max(time_tokenizer(tokenize_fn, texts, num_repeats), 1e-9)
+  return BenchmarkResult(
+      tokens_per_sec=num_tokens / elapsed,
+      words_per_sec=num_words / elapsed,
+      peak_memory_bytes=peak_memory,
+      fingerprint=hasher.hexdigest())
+
+
+def make_tokenizers(vocab_file, do_lower_case):
+  """Returns the tokenize functions to benchmark, by name."""
+  basic = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+  full = tokenization.FullTokenizer(vocab_file=vocab_file,
+                                    do_lower_case=do_lower_case)
+  full_cached = tokenization.FullTokenizer(vocab_file=vocab_file,
+                                           do_lower_case=do_lower_case,
+                                           cache_size=100000)
+
+  # WordpieceTokenizer expects text that went through BasicTokenizer.
+  def wordpiece(text):
+    return full.wordpiece_tokenizer.tokenize(text)
+
+  return collections.OrderedDict([
+      ("basic", (basic.tokenize, False)),
+      ("wordpiece", (wordpiece, True)),
+      ("full", (full.tokenize, False)),
+      ("full_cached", (full_cached.tokenize, False)),
+  ]), basic
+
+
+def benchmark_all(texts_by_dataset, vocab_file, do_lower_case, num_repeats):
+  """Runs every tokenizer over every dataset. Returns a dict of results."""
+  tokenizers, basic = make_tokenizers(vocab_file, do_lower_case)
+  results = collections.OrderedDict()
+  for dataset, texts in texts_by_dataset.items():
+    pretokenized = [u" ".join(basic.tokenize(text)) for text in texts]
+    for name, (tokenize_fn, wants_pretokenized) in tokenizers.items():
+      inputs = pretokenized if wants_pretokenized else texts
+      result = run_benchmark(tokenize_fn, inputs, num_repeats)
+      results["%s/%s" % (name, dataset)] = result
+      if result.peak_memory_bytes is None:
+        peak_memory = "%10s" % "n/a"
+      else:
+        peak_memory = "%10.1f" % (result.peak_memory_bytes / 1024.0)
+      print("%-28s %12.0f tokens/s %12.0f words/s %s KiB peak  %s" %
+            ("%s/%s" % (name, dataset), result.tokens_per_sec,
+             result.words_per_sec, peak_memory, result.fingerprint[:12]))
+  return results
+
+
+def get_config(vocab_file, do_lower_case):
+  """Returns what the fingerprints depend on besides the tokenizer code."""
+  hasher = hashlib.sha1()
+  with tf.gfile.GFile(vocab_file, "rb") as reader:
+    hasher.update(reader.read())
+  return collections.OrderedDict([("vocab_sha1", hasher.hexdigest()),
+                                  ("do_lower_case", bool(do_lower_case))])
+
+
+def check_against_baseline(results, baseline, max_slowdown):
+  """Returns the list of regressions of `results` with respect to `baseline`."""
+  errors = []
+  for key, result in results.items():
+    if key not in baseline:
+      errors.append("%s: not in the baseline" % key)
+      continue
+    expected = BenchmarkResult(**baseline[key])
+    if result.fingerprint != expected.fingerprint:
+      errors.append("%s: tokenizer output changed" % key)
+    min_speed = expected.tokens_per_sec * (1.0 - max_slowdown)
+    if result.tokens_per_sec < min_speed:
+      errors.append("%s: %.0f tokens/s is slower than the baseline %.0f" %
+                    (key, result.tokens_per_sec, expected.tokens_per_sec))
+  return errors
+
+
+def benchmark_ascii_fast_path(texts, do_lower_case, num_repeats):
+  """Compares the ASCII fast path of `BasicTokenizer` with the full path."""
+  tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
+  ascii_texts = [text for text in texts if tokenization._is_ascii(text)]
+
+  for text in ascii_texts:
+    if tokenizer._tokenize_ascii(text) != tokenizer._tokenize_unicode(text):
+      raise ValueError("ASCII fast path output differs for: %r" % text)
+
+  full_time = time_tokenizer(tokenizer._tokenize_unicode, ascii_texts,
+                             num_repeats)
+  fast_time = time_tokenizer(tokenizer._tokenize_ascii, ascii_texts,
+                             num_repeats)
+
+  print("ASCII fast path (%d of %d texts are ASCII)" %
+        (len(ascii_texts), len(texts)))
+  print("  full path:  %.4f s" % full_time)
+  print("  ASCII path: %.4f s" % fast_time)
+  print("  speedup:    %.2fx" % (full_time / max(fast_time, 1e-9)))
+
+
+def main(_):
+  texts = read_texts(FLAGS.data_dir)
+  benchmark_ascii_fast_path(texts, FLAGS.do_lower_case, FLAGS.num_repeats)
+
+  texts_by_dataset = collections.OrderedDict([("qc", texts)])
+  texts_by_dataset.update(make_stress_texts())
+  results = benchmark_all(texts_by_dataset, FLAGS.vocab_file,
+                          FLAGS.do_lower_case, FLAGS.num_repeats)
+
+  if not FLAGS.baseline_file:
+    return 0
+
+  config = get_config(FLAGS.vocab_file, FLAGS.do_lower_case)
+  if FLAGS.save_baseline:
+    baseline = collections.OrderedDict([(CONFIG_KEY, config)])
+    baseline.update(
+        (key, result._asdict()) for key, result in results.items())
+    with tf.gfile.GFile(FLAGS.baseline_file, "w") as writer:
+      json.dump(baseline, writer, indent=2)
+    print("Saved baseline to %s" % FLAGS.baseline_file)
+    return 0
+
+  if not tf.gfile.Exists(FLAGS.baseline_file):
+    print("ERROR baseline %s does not exist; record one with --save_baseline" %
+          FLAGS.baseline_file)
+    return 1
+  with tf.gfile.GFile(FLAGS.baseline_file, "r") as reader:
+    baseline = json.load(reader)
+  if baseline.pop(CONFIG_KEY, None) != config:
+    print("ERROR baseline %s was not recorded with this vocab_file and "
+          "do_lower_case" % FLAGS.baseline_file)
+    return 1
+  errors = check_against_baseline(results, baseline, FLAGS.max_slowdown)
+  for error in errors:
+    print("REGRESSION %s" % error)
+  if errors:
+    return 1
+  print("No regression with respect to %s" % FLAGS.baseline_file)
+  return 0
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("vocab_file")
+  tf.app.run()
@@ -15,12 +15,14 @@ import os
 import modeling
 import optimization
 import tokenization
+import tokenization_cache
+import feature_store
 import tensorflow as tf
 import numpy as np
 import random
 import tf_metrics
 
-from data_processors import InputFeatures, PaddingInputExample, QcFineProcessor
+from data_processors import Deduplicator, InputFeatures, PaddingInputExample, get_processor
 
 flags = tf.flags
 
@@ -36,7 +38,28 @@ flags.DEFINE_string(
     "The config json file corresponding to the pre-trained BERT model. "
     "This specifies the model architecture.")
 
-flags.DEFINE_string("task_name", None, "The name of the task to train.")
+flags.DEFINE_string("task_name", None,
+                    "The name of the task to train, a key of "
+                    "`data_processors.PROCESSORS`: qc-fine for the "
+                    "ProgrammerWeb CSV given as --input_file, or qc-tsv "
+                    "for the QC files in --data_dir.")
+
+flags.DEFINE_string(
+    "input_file", "../../datasets/multiLabel_text_classification/ProgrammerWeb/programweb-data.csv",
+    "Data file of the tasks reading a single file, such as the ProgrammerWeb "
+    "CSV of qc-fine. May be compressed with gzip or bzip2.")
+
+flags.DEFINE_enum(
+    "dedup_mode", "none", ["none", "exact", "near"],
+    "Duplicate examples dropped while loading: none, \"exact\" for texts "
+    "equal once case-folded and stripped of punctuation, or \"near\" to "
+    "also drop the texts close to a kept one by MinHash, see "
+    "`data_processors.Deduplicator`.")
+
+flags.DEFINE_float(
+    "near_duplicate_threshold", 0.8,
+    "Estimated Jaccard similarity of character 5-grams above which "
+    "--dedup_mode=near drops a text.")
 
 flags.DEFINE_string("vocab_file", None,
                     "The vocabulary file that the BERT model was trained on.")
@@ -54,6 +77,16 @@ flags.DEFINE_bool(
     "Whether to lower case the input text. Should be True for uncased "
     "models and False for cased models.")
 
+flags.DEFINE_integer(
+    "tokenizer_cache_size", 100000,
+    "Number of distinct words whose WordPiece tokenization is memoized in an "
+    "LRU cache. Set to 0 to disable the cache.")
+
+flags.DEFINE_string(
+    "tokenization_cache_dir", None,
+    "[Optional] Directory of a persistent cache of tokenized texts, keyed by "
+    "text, vocabulary and casing, that is reused across runs.")
+
 flags.DEFINE_integer(
     "max_seq_length", 128,
     "The maximum total input sequence length after WordPiece tokenization. "
@@ -119,6 +152,14 @@ flags.DEFINE_integer(
 flags.DEFINE_float("label_rate", 1.0,
                    "Rate for labeled examples (Used only for logging purpose).")
 
+flags.DEFINE_enum(
+    "record_format", "padded", ["padded", "npy"],
+    "How the features are stored. `padded` writes TFRecord files, `npy` "
+    "memory-mapped NumPy arrays, see feature_store.py.")
+
+# Number of examples converted and written to a feature store at a time.
+STORE_CHUNK_SIZE = 4096
+
 
 SEED=0
 np.random.seed(SEED)
@@ -142,82 +183,29 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
   for (i, label) in enumerate(label_list):
     label_map[label] = i
 
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
-
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
-    # length is less than the specified length.
-    # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-  else:
-    # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-  # The convention in BERT is:
-  # (a) For sequence pairs:
-  #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-  #  type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
-  # (b) For single sequences:
-  #  tokens:   [CLS] the dog is hairy . [SEP]
-  #  type_ids: 0     0   0   0  0     0 0
-  #
-  # Where "type_ids" are used to indicate whether this is the first
-  # sequence or the second sequence. The embedding vectors for `type=0` and
-  # `type=1` were learned during pre-training and are added to the wordpiece
-  # embedding vector (and position vector). This is not *strictly* necessary
-  # since the [SEP] token unambiguously separates the sequences, but it makes
-  # it easier for the model to learn the concept of sequences.
-  #
-  # For classification tasks, the first vector (corresponding to [CLS]) is
-  # used as the "sentence vector". Note that this only makes sense because
-  # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-  # The mask has 1 for real tokens and 0 for padding tokens. Only real
-  # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
-
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
-
-  label_id = label_map[example.label]
+  # See `FullTokenizer.encode` for the [CLS]/[SEP] and segment id layout.
+  input_ids, input_mask, segment_ids = tokenizer.encode(
+      example.text_a, example.text_b, max_seq_length)
+
+  label = example.label
+  if isinstance(label, list):
+    # Processors of multi-label data give lists of labels, which this
+    # single-label classifier takes when they hold exactly one.
+    if len(label) != 1:
+      raise ValueError("Example %s has %d labels, 1 expected." %
+                       (example.guid, len(label)))
+    label = label[0]
+  label_id = label_map[label]
   if ex_index < 5:
     tf.logging.info("*** Example ***")
     tf.logging.info("guid: %s" % (example.guid))
+    tokens = tokenizer.convert_ids_to_tokens(input_ids[:input_mask.sum()])
     tf.logging.info("tokens: %s" % " ".join(
         [tokenization.printable_text(x) for x in tokens]))
     tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
     tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
     tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-    tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
+    tf.logging.info("label: %s (id = %d)" % (label, label_id))
 
   feature = InputFeatures(
       input_ids=input_ids,
@@ -230,7 +218,12 @@ def convert_single_example(ex_index, example, label_list, max_seq_length,
 
 def file_based_convert_examples_to_features(
     examples, label_list, max_seq_length, tokenizer, output_file):
-  """Convert a set of `InputExample`s to a TFRecord file."""
+  """Convert a set of `InputExample`s, or an `ExampleTable`, to a TFRecord file."""
+
+  if FLAGS.record_format == "npy":
+    store_based_convert_examples_to_features(
+        examples, label_list, max_seq_length, tokenizer, output_file)
+    return
 
   writer = tf.python_io.TFRecordWriter(output_file)
 
@@ -257,6 +250,60 @@ def file_based_convert_examples_to_features(
     writer.write(tf_example.SerializeToString())
   writer.close()
 
+  if tokenizer.ids_cache is not None:
+    tokenizer.ids_cache.save()
+
+
+def store_based_convert_examples_to_features(
+    examples, label_list, max_seq_length, tokenizer, store_dir):
+  """Convert a set of `InputExample`s, or an `ExampleTable`, to a `feature_store` directory."""
+  writer = feature_store.FeatureStoreWriter(
+      store_dir, len(examples),
+      feature_store.get_token_dtype(len(tokenizer.inv_vocab)))
+  for start in range(0, len(examples), STORE_CHUNK_SIZE):
+    tf.logging.info("Writing example %d of %d" % (start, len(examples)))
+    features = [
+        convert_single_example(ex_index, example, label_list, max_seq_length,
+                               tokenizer)
+        for ex_index, example in enumerate(
+            examples[start:start + STORE_CHUNK_SIZE], start)]
+    arrays = collections.OrderedDict()
+    for name in ["input_ids", "input_mask", "segment_ids"]:
+      arrays[name] = np.array([getattr(f, name) for f in features],
+                              dtype=np.int32)
+    arrays["label_ids"] = np.array([f.label_id for f in features],
+                                   dtype=np.int32)
+    arrays["is_real_example"] = np.array(
+        [f.is_real_example for f in features], dtype=np.int32)
+    writer.write(arrays)
+  writer.close()
+
+  if tokenizer.ids_cache is not None:
+    tokenizer.ids_cache.save()
+
+
+def get_feature_file(name):
+  """Returns the path in output_dir of the features called `name`."""
+  if FLAGS.record_format == "npy":
+    return os.path.join(FLAGS.output_dir, name + feature_store.STORE_EXTENSION)
+  return os.path.join(FLAGS.output_dir, name + ".tf_record")
+
+
+def feature_input_fn_builder(input_file, seq_length, is_training,
+                             drop_remainder):
+  """Creates an `input_fn` for the features written in --record_format."""
+  if FLAGS.record_format == "npy":
+    return feature_store.input_fn_builder(
+        store_dirs=input_file,
+        is_training=is_training,
+        drop_remainder=drop_remainder,
+        seed=SEED)
+  return file_based_input_fn_builder(
+      input_file=input_file,
+      seq_length=seq_length,
+      is_training=is_training,
+      drop_remainder=drop_remainder)
+
 
 def file_based_input_fn_builder(input_file, seq_length, is_training,
                                 drop_remainder):
@@ -306,23 +353,6 @@ def file_based_input_fn_builder(input_file, seq_length, is_training,
   return input_fn
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-  """Truncates a sequence pair in place to the maximum length."""
-
-  # This is a simple heuristic which will always truncate the longer sequence
-  # one token at a time. This makes more sense than truncating an equal percent
-  # of tokens from each, since if one sequence is very short then each token
-  # that's truncated likely contains more information than a longer sequence.
-  while True:
-    total_length = len(tokens_a) + len(tokens_b)
-    if total_length <= max_length:
-      break
-    if len(tokens_a) > len(tokens_b):
-      tokens_a.pop()
-    else:
-      tokens_b.pop()
-
-
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
                  labels, num_labels, use_one_hot_embeddings):
   """Creates a classification model."""
@@ -474,10 +504,10 @@ def evaluate(estimator, label_rate, eval_examples, task_name, label_list, tokeni
         # will get dropped. So we pad with fake examples which are ignored
         # later on. These do NOT count towards the metric (all tf.metrics
         # support a per-instance weight, and these get a weight of 0.0).
-        while len(eval_examples) % FLAGS.eval_batch_size != 0:
-            eval_examples.append(PaddingInputExample())
+        eval_examples.extend([PaddingInputExample()] *
+                             (-len(eval_examples) % FLAGS.eval_batch_size))
 
-    eval_file = os.path.join(FLAGS.output_dir, "eval_"+str(task_name)+".tf_record")
+    eval_file = get_feature_file("eval_"+str(task_name))
     file_based_convert_examples_to_features(
         eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
 
@@ -496,7 +526,7 @@ def evaluate(estimator, label_rate, eval_examples, task_name, label_list, tokeni
         eval_steps = int(len(eval_examples) // FLAGS.eval_batch_size)
 
     eval_drop_remainder = True if FLAGS.use_tpu else False
-    eval_input_fn = file_based_input_fn_builder(
+    eval_input_fn = feature_input_fn_builder(
         input_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
@@ -522,7 +552,6 @@ def evaluate(estimator, label_rate, eval_examples, task_name, label_list, tokeni
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
 
-  processors = {"qc-fine": QcFineProcessor}
 
   label_rate = FLAGS.label_rate
 
@@ -545,15 +574,25 @@ def main(_):
 
   task_name = FLAGS.task_name.lower()
 
-  if task_name not in processors:
-    raise ValueError("Task not found: %s" % (task_name))
+  deduplicator = None
+  if FLAGS.dedup_mode != "none":
+    deduplicator = Deduplicator(
+        near_duplicates=FLAGS.dedup_mode == "near",
+        threshold=FLAGS.near_duplicate_threshold, seed=SEED)
 
-  processor = processors[task_name]()
+  processor = get_processor(task_name, deduplicator=deduplicator)
+  processor.load_examples(FLAGS.data_dir, input_file=FLAGS.input_file)
+  if deduplicator is not None:
+    tf.logging.info(deduplicator.summary())
 
   label_list = processor.get_labels()
 
   tokenizer = tokenization.FullTokenizer(
-      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case,
+      cache_size=FLAGS.tokenizer_cache_size)
+  if FLAGS.tokenization_cache_dir:
+    tokenizer.ids_cache = tokenization_cache.TokenizationCache(
+        FLAGS.tokenization_cache_dir, FLAGS.vocab_file, FLAGS.do_lower_case)
 
   tpu_cluster_resolver = None
   if FLAGS.use_tpu and FLAGS.tpu_name:
@@ -602,14 +641,14 @@ def main(_):
       predict_batch_size=FLAGS.predict_batch_size)
 
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
+    train_file = get_feature_file("train")
     file_based_convert_examples_to_features(
         train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
     tf.logging.info("***** Running training *****")
     tf.logging.info("  Num examples = %d", len(train_examples))
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", num_train_steps)
-    train_input_fn = file_based_input_fn_builder(
+    train_input_fn = feature_input_fn_builder(
         input_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
@@ -629,10 +668,10 @@ def main(_):
       # of examples must be a multiple of the batch size, or else examples
       # will get dropped. So we pad with fake examples which are ignored
       # later on.
-      while len(predict_examples) % FLAGS.predict_batch_size != 0:
-        predict_examples.append(PaddingInputExample())
+      predict_examples.extend([PaddingInputExample()] *
+                              (-len(predict_examples) % FLAGS.predict_batch_size))
 
-    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+    predict_file = get_feature_file("predict")
     file_based_convert_examples_to_features(predict_examples, label_list,
                                             FLAGS.max_seq_length, tokenizer,
                                             predict_file)
@@ -644,7 +683,7 @@ def main(_):
     tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
 
     predict_drop_remainder = True if FLAGS.use_tpu else False
-    predict_input_fn = file_based_input_fn_builder(
+    predict_input_fn = feature_input_fn_builder(
         input_file=predict_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
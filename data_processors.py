@@ -5,14 +5,27 @@
 # Data processor for the QC dataset
 
 import os
+import bz2
+import collections
 import csv
+import gzip
+import hashlib
+import itertools
+import math
+import random
+import re
+import unicodedata
+import zlib
 import tensorflow as tf
 import tokenization
 import numpy as np
+from multiprocessing.pool import ThreadPool
 
 class InputExample(object):
   """A single training/test example for simple sequence classification."""
 
+  __slots__ = ("guid", "text_a", "text_b", "label")
+
   def __init__(self, guid, text_a, text_b=None, label=None):
     """Constructs a InputExample.
 
@@ -43,10 +56,15 @@ class PaddingInputExample(object):
   battches could cause silent errors.
   """
 
+  __slots__ = ()
+
 
 class InputFeatures(object):
   """A single set of features of data."""
 
+  __slots__ = ("input_ids", "input_mask", "segment_ids", "label_id",
+               "is_real_example", "label_mask")
+
   def __init__(self,
                input_ids,
                input_mask,
@@ -62,6 +80,318 @@ class InputFeatures(object):
     self.label_mask = label_mask
 
 
+# Kinds of the labels stored in an `ExampleTable`.
+_NO_LABEL = 0
+_SINGLE_LABEL = 1
+_MULTI_LABEL = 2
+
+
+class ExampleTable(object):
+  """Columnar storage of many `InputExample`s and `PaddingInputExample`s.
+
+  Rather than one object per example, the table keeps a few flat columns:
+    - `text_buffer`: the UTF-8 bytes of the guid, text_a and text_b of every
+      row, back to back. Those of row i are delimited by
+      `text_offsets[3 * i:3 * i + 4]`, and `has_text_b[i]` tells an empty
+      text_b from None. Guids are stored as strings.
+    - `label_ids`: the labels of every row in CSR layout, as indices into
+      `label_names`; those of row i are
+      `label_ids[label_offsets[i]:label_offsets[i + 1]]`. `label_kinds[i]`
+      tells whether the label is None, a single label or a list of them.
+    - `is_real`: False for the rows standing for `PaddingInputExample`s.
+
+  The table behaves like a list of examples: indexing returns an
+  `ExampleRow` view (or a `PaddingInputExample`), slicing and `take` return
+  new tables, and `append` and `+` accept examples, lists and tables. The
+  converters in ganbert.py and bert.py accept it wherever they take a list
+  of examples.
+  """
+
+  __slots__ = ("text_buffer", "text_offsets", "has_text_b", "label_names",
+               "label_ids", "label_offsets", "label_kinds", "is_real")
+
+  def __init__(self, text_buffer, text_offsets, has_text_b, label_names,
+               label_ids, label_offsets, label_kinds, is_real):
+    self.text_buffer = text_buffer
+    self.text_offsets = text_offsets
+    self.has_text_b = has_text_b
+    self.label_names = label_names
+    self.label_ids = label_ids
+    self.label_offsets = label_offsets
+    self.label_kinds = label_kinds
+    self.is_real = is_real
+
+  @classmethod
+  def from_columns(cls, guids, texts_a, labels, texts_b=None, is_real=None):
+    """Builds a table from one list per field.
+
+    Args:
+      guids: List of N guids.
+      texts_a: List of N strings.
+      labels: List of N labels: None, a label or a list of labels.
+      texts_b: (Optional) list of N strings or Nones.
+      is_real: (Optional) list of N booleans, False for padding rows.
+    """
+    num_rows = len(guids)
+    if texts_b is None:
+      texts_b = [None] * num_rows
+    if is_real is None:
+      is_real = [True] * num_rows
+
+    pieces = []
+    text_offsets = np.zeros([3 * num_rows + 1], dtype=np.int64)
+    position = 0
+    for i, row in enumerate(zip(guids, texts_a, texts_b)):
+      for j, text in enumerate(row):
+        if text is not None:
+          piece = tokenization.convert_to_unicode(str(text)).encode("utf-8")
+          pieces.append(piece)
+          position += len(piece)
+        text_offsets[3 * i + j + 1] = position
+
+    label_index = collections.OrderedDict()
+    label_ids = []
+    label_offsets = np.zeros([num_rows + 1], dtype=np.int64)
+    label_kinds = np.zeros([num_rows], dtype=np.int8)
+    for i, label in enumerate(labels):
+      if label is None:
+        row_labels = []
+      elif isinstance(label, (list, tuple)):
+        label_kinds[i] = _MULTI_LABEL
+        row_labels = label
+      else:
+        label_kinds[i] = _SINGLE_LABEL
+        row_labels = [label]
+      for name in row_labels:
+        index = label_index.get(name)
+        if index is None:
+          index = label_index[name] = len(label_index)
+        label_ids.append(index)
+      label_offsets[i + 1] = len(label_ids)
+
+    return cls(text_buffer=b"".join(pieces),
+               text_offsets=text_offsets,
+               has_text_b=np.array([t is not None for t in texts_b],
+                                   dtype=bool),
+               label_names=list(label_index),
+               label_ids=np.array(label_ids, dtype=np.int32),
+               label_offsets=label_offsets,
+               label_kinds=label_kinds,
+               is_real=np.array(is_real, dtype=bool))
+
+  @classmethod
+  def from_examples(cls, examples):
+    """Builds a table from `InputExample`s and `PaddingInputExample`s."""
+    if isinstance(examples, ExampleTable):
+      return examples
+    guids, texts_a, texts_b, labels, is_real = [], [], [], [], []
+    for example in examples:
+      if isinstance(example, PaddingInputExample):
+        guids.append(None)
+        texts_a.append(None)
+        texts_b.append(None)
+        labels.append(None)
+        is_real.append(False)
+      else:
+        guids.append(example.guid)
+        texts_a.append(example.text_a)
+        texts_b.append(example.text_b)
+        labels.append(example.label)
+        is_real.append(True)
+    return cls.from_columns(guids, texts_a, labels, texts_b=texts_b,
+                            is_real=is_real)
+
+  def __len__(self):
+    return len(self.is_real)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return self.take(range(*index.indices(len(self))))
+    if not isinstance(index, (int, np.integer)):
+      return self.take(index)
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("ExampleTable index out of range")
+    if not self.is_real[index]:
+      return PaddingInputExample()
+    return ExampleRow(self, int(index))
+
+  def __add__(self, other):
+    return ExampleTable.concatenate([self, other])
+
+  def __radd__(self, other):
+    return ExampleTable.concatenate([other, self])
+
+  def append(self, example):
+    """Appends one example in place.
+
+    Every call copies the whole table, so appending in a loop is quadratic;
+    `extend` with all the examples at once instead.
+    """
+    self.extend([example])
+
+  def extend(self, examples):
+    """Appends examples, or the rows of another table, in place."""
+    if not len(examples):
+      return
+    table = ExampleTable.concatenate([self, examples])
+    for name in ExampleTable.__slots__:
+      setattr(self, name, getattr(table, name))
+
+  def update_hash(self, hasher):
+    """Feeds the content of the table to a `hashlib` object.
+
+    The columns are hashed as stored, each preceded by its size, which takes
+    a few passes over the raw bytes instead of one object per row.
+    """
+    columns = [u"\x00".join(self.label_names).encode("utf-8")]
+    columns.extend(np.ascontiguousarray(getattr(self, name)).tobytes()
+                   for name in ["text_offsets", "has_text_b", "label_ids",
+                                "label_offsets", "label_kinds", "is_real"])
+    columns.append(self.text_buffer)
+    for column in columns:
+      hasher.update(np.int64(len(column)).tobytes())
+      hasher.update(column)
+
+  def _get_text(self, index, field):
+    start, end = self.text_offsets[3 * index + field:3 * index + field + 2]
+    return self.text_buffer[start:end].decode("utf-8")
+
+  def get_guid(self, index):
+    return self._get_text(index, 0)
+
+  def get_text_a(self, index):
+    return self._get_text(index, 1)
+
+  def get_text_b(self, index):
+    if not self.has_text_b[index]:
+      return None
+    return self._get_text(index, 2)
+
+  def get_label(self, index):
+    kind = self.label_kinds[index]
+    if kind == _NO_LABEL:
+      return None
+    names = [self.label_names[i] for i in self.label_ids[
+        self.label_offsets[index]:self.label_offsets[index + 1]]]
+    if kind == _SINGLE_LABEL:
+      return names[0]
+    return names
+
+  def get_texts_a(self):
+    return [self.get_text_a(i) for i in range(len(self))]
+
+  def get_texts_b(self):
+    return [self.get_text_b(i) for i in range(len(self))]
+
+  def get_label_coordinates(self, label_map):
+    """Returns the (rows, `label_map` indices) of every label of the table."""
+    rows = np.repeat(np.arange(len(self)), np.diff(self.label_offsets))
+    columns = np.array([label_map[name] for name in self.label_names],
+                       dtype=np.int64)
+    return rows, columns[self.label_ids]
+
+  def take(self, indices):
+    """Returns a new table with the rows at `indices`, in that order."""
+    indices = np.asarray(indices, dtype=np.int64).reshape([-1])
+    row_starts = self.text_offsets[3 * indices]
+    row_lengths = self.text_offsets[3 * indices + 3] - row_starts
+    text_offsets = np.zeros([3 * len(indices) + 1], dtype=np.int64)
+    text_offsets[3::3] = np.cumsum(row_lengths)
+    for field in [1, 2]:
+      text_offsets[field:-1:3] = text_offsets[0:-1:3] + (
+          self.text_offsets[3 * indices + field] - row_starts)
+    text_buffer = b"".join(
+        self.text_buffer[start:start + length]
+        for start, length in zip(row_starts.tolist(), row_lengths.tolist()))
+
+    label_starts = self.label_offsets[indices]
+    label_lengths = self.label_offsets[indices + 1] - label_starts
+    label_offsets = np.zeros([len(indices) + 1], dtype=np.int64)
+    label_offsets[1:] = np.cumsum(label_lengths)
+    label_positions = np.repeat(label_starts - label_offsets[:-1],
+                                label_lengths) + np.arange(label_offsets[-1])
+
+    return ExampleTable(text_buffer=text_buffer,
+                        text_offsets=text_offsets,
+                        has_text_b=self.has_text_b[indices],
+                        label_names=self.label_names,
+                        label_ids=self.label_ids[label_positions],
+                        label_offsets=label_offsets,
+                        label_kinds=self.label_kinds[indices],
+                        is_real=self.is_real[indices])
+
+  @staticmethod
+  def concatenate(tables):
+    """Concatenates tables, or lists of examples, into a new table."""
+    tables = [ExampleTable.from_examples(t) for t in tables]
+    label_index = collections.OrderedDict()
+    label_ids = []
+    for table in tables:
+      for name in table.label_names:
+        if name not in label_index:
+          label_index[name] = len(label_index)
+      remap = np.array([label_index[name] for name in table.label_names],
+                       dtype=np.int32)
+      label_ids.append(remap[table.label_ids])
+
+    def concatenate_offsets(offsets):
+      shifts = np.cumsum([0] + [o[-1] for o in offsets[:-1]])
+      return np.concatenate(
+          [offsets[0][:1]] +
+          [o[1:] + shift for o, shift in zip(offsets, shifts)])
+
+    return ExampleTable(
+        text_buffer=b"".join(table.text_buffer for table in tables),
+        text_offsets=concatenate_offsets(
+            [table.text_offsets for table in tables]),
+        has_text_b=np.concatenate([table.has_text_b for table in tables]),
+        label_names=list(label_index),
+        label_ids=np.concatenate(label_ids),
+        label_offsets=concatenate_offsets(
+            [table.label_offsets for table in tables]),
+        label_kinds=np.concatenate([table.label_kinds for table in tables]),
+        is_real=np.concatenate([table.is_real for table in tables]))
+
+
+class ExampleRow(object):
+  """Read-only `InputExample` view of one row of an `ExampleTable`."""
+
+  __slots__ = ("table", "index")
+
+  def __init__(self, table, index):
+    self.table = table
+    self.index = index
+
+  @property
+  def guid(self):
+    return self.table.get_guid(self.index)
+
+  @property
+  def text_a(self):
+    return self.table.get_text_a(self.index)
+
+  @property
+  def text_b(self):
+    return self.table.get_text_b(self.index)
+
+  @property
+  def label(self):
+    return self.table.get_label(self.index)
+
+
+def take_examples(examples, indices):
+  """Returns the examples at `indices`, as a table for an `ExampleTable`."""
+  if isinstance(examples, ExampleTable):
+    return examples.take(indices)
+  return [examples[i] for i in indices]
+
+
 class DataProcessor(object):
   """Base class for data converters for sequence classification data sets."""
 
@@ -81,62 +411,279 @@ class DataProcessor(object):
     """Gets the list of labels for this data set."""
     raise NotImplementedError()
 
+  def load_examples(self, data_dir, input_file=None):
+    """Reads the data set before the examples are requested, if needed.
+
+    `input_file` is the data file of the processors that read a single one.
+    """
+    pass
+
   @classmethod
   def _read_tsv(cls, input_file, quotechar=None):
     """Reads a tab separated value file."""
+    return list(cls._iter_tsv(input_file, quotechar=quotechar))
+
+  @classmethod
+  def _iter_tsv(cls, input_file, quotechar=None):
+    """Lazily reads a tab separated value file, one row at a time."""
     with tf.gfile.Open(input_file, "r") as f:
       reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-      lines = []
       for line in reader:
-        lines.append(line)
-      return lines
+        yield line
+
+def reservoir_sample(iterable, num_samples, seed=0):
+  """Draws `num_samples` items of `iterable` uniformly, in a single pass.
+
+  Only the sampled items are kept in memory, and the items that cannot be
+  sampled are skipped without drawing a random number each (Li's
+  "Algorithm L"), so this suits streams much larger than the sample. The
+  sample only depends on `seed` and on the stream, and is returned in the
+  order of the stream. Every item is returned when the stream has at most
+  `num_samples` of them.
+  """
+  if num_samples <= 0:
+    return []
+  rng = random.Random(seed)
+
+  def random_log():
+    # log of a uniform sample from (0, 1).
+    u = rng.random()
+    while u == 0.0:
+      u = rng.random()
+    return math.log(u)
+
+  items = enumerate(iterable)
+  reservoir = list(itertools.islice(items, num_samples))
+  if len(reservoir) == num_samples:
+    w = math.exp(random_log() / num_samples)
+    while w < 1.0:
+      skip = int(random_log() / math.log1p(-w))
+      item = next(itertools.islice(items, skip, None), None)
+      if item is None:
+        break
+      reservoir[rng.randrange(num_samples)] = item
+      w *= math.exp(random_log() / num_samples)
+  reservoir.sort(key=lambda item: item[0])
+  return [value for _, value in reservoir]
+
+
+class Deduplicator(object):
+  """Streaming filter of duplicate texts.
+
+  `is_duplicate` is called on each text in turn and tells whether it repeats
+  one of the texts seen before; only the texts kept are remembered. Texts
+  are compared after `normalize_text`, by a 64-bit hash.
+
+  With `near_duplicates`, texts whose estimated Jaccard similarity to a kept
+  text is at least `threshold` are dropped too. The similarity is that of
+  their sets of character `shingle_size`-grams, estimated by MinHash
+  signatures of `num_hashes` values, and the candidates are found by
+  locality-sensitive hashing of the signatures in `num_bands` bands. Pairs
+  less similar than (1 / num_bands) ** (num_bands / num_hashes) are rarely
+  compared at all.
+  """
+
+  # The largest prime below 2**32. The hash functions of the signatures are
+  # (a * x + b) mod _PRIME with a, b and x below it, so they fit in uint64.
+  _PRIME = (1 << 32) - 5
+
+  def __init__(self, near_duplicates=False, threshold=0.8, num_hashes=64,
+               num_bands=16, shingle_size=5, seed=0):
+    if num_hashes % num_bands != 0:
+      raise ValueError("num_hashes (%d) must be a multiple of num_bands (%d)" %
+                       (num_hashes, num_bands))
+    self.near_duplicates = near_duplicates
+    self.threshold = threshold
+    self.num_bands = num_bands
+    self.shingle_size = shingle_size
+    self.num_seen = 0
+    self.num_exact_duplicates = 0
+    self.num_near_duplicates = 0
+    self._hashes = set()
+    self._signatures = []
+    self._bands = [{} for _ in range(num_bands)]
+    rng = np.random.RandomState(seed)
+    self._a = rng.randint(1, self._PRIME, size=[num_hashes, 1],
+                          dtype=np.int64).astype(np.uint64)
+    self._b = rng.randint(0, self._PRIME, size=[num_hashes, 1],
+                          dtype=np.int64).astype(np.uint64)
+
+  @property
+  def num_dropped(self):
+    return self.num_exact_duplicates + self.num_near_duplicates
+
+  def is_duplicate(self, text):
+    """Returns whether `text` duplicates a kept text, else keeps it."""
+    self.num_seen += 1
+    text = normalize_text(text)
+    digest = hashlib.md5(text.encode("utf-8")).digest()[:8]
+    if digest in self._hashes:
+      self.num_exact_duplicates += 1
+      return True
+    if self.near_duplicates:
+      signature = self._get_signature(text)
+      data = signature.tobytes()
+      band_size = len(data) // self.num_bands
+      band_keys = [data[i:i + band_size]
+                   for i in range(0, len(data), band_size)]
+      candidates = set()
+      for band, key in zip(self._bands, band_keys):
+        candidates.update(band.get(key, ()))
+      for candidate in candidates:
+        similarity = np.mean(self._signatures[candidate] == signature)
+        if similarity >= self.threshold:
+          self.num_near_duplicates += 1
+          return True
+      for band, key in zip(self._bands, band_keys):
+        band.setdefault(key, []).append(len(self._signatures))
+      self._signatures.append(signature)
+    self._hashes.add(digest)
+    return False
+
+  def _get_signature(self, text):
+    size = self.shingle_size
+    shingles = set(text[i:i + size]
+                   for i in range(max(len(text) - size + 1, 1)))
+    x = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles],
+                 dtype=np.uint64) % np.uint64(self._PRIME)
+    signature = ((self._a * x + self._b) % np.uint64(self._PRIME)).min(axis=1)
+    return signature.astype(np.uint32)
+
+  def summary(self):
+    return ("Dropped %d of %d examples as duplicates (%d exact, %d near)" %
+            (self.num_dropped, self.num_seen, self.num_exact_duplicates,
+             self.num_near_duplicates))
+
+
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_text(text):
+  """Case-folds `text` and reduces it to its words, for `Deduplicator`."""
+  text = unicodedata.normalize("NFKC", tokenization.convert_to_unicode(text))
+  return _NON_WORD_RE.sub(" ", text.casefold()).strip()
+
+
+def open_data_file(input_file):
+  """Opens a data file for reading text, decompressing ".gz" and ".bz2" files.
+
+  The file is opened with `newline=''`, as `csv.reader` expects.
+  """
+  if input_file.endswith(".gz"):
+    return gzip.open(input_file, "rt", newline='')
+  if input_file.endswith(".bz2"):
+    return bz2.open(input_file, "rt", newline='')
+  return open(input_file, newline='')
+
+
+def get_data_format(input_file):
+  """Returns the extension of a data file, ignoring any compression suffix."""
+  root, ext = os.path.splitext(input_file)
+  if ext in [".gz", ".bz2"]:
+    ext = os.path.splitext(root)[1]
+  return ext
+
+
+def iter_texts(input_file):
+  """Lazily yields the texts of a data file, one row at a time.
+
+  Supports the two formats handled by the processors in this module:
+    - ".csv": the ProgrammerWeb catalog read by `QcFineProcessor`, with the
+      columns id, title, description and tags. The text is the title followed
+      by the description.
+    - ".tsv": the QC files in data/, with a header line and then one
+      "<coarse>:<fine> <question>" line per example.
+
+  Either can be compressed with gzip or bzip2 (".csv.gz", ".tsv.bz2", ...).
+
+  The file is never fully loaded, so this can feed `FullTokenizer.iter_encode`
+  with corpora that do not fit in memory.
+  """
+  data_format = get_data_format(input_file)
+  if data_format == ".csv":
+    with open_data_file(input_file) as f:
+      reader = csv.reader(f)
+      next(reader, None)
+      for row in reader:
+        if len(row) != 4:
+          continue
+        _, title, dscp, _ = row
+        yield tokenization.convert_to_unicode(title + dscp)
+  elif data_format == ".tsv":
+    for _, text in iter_qc_tsv(input_file):
+      yield text
+  else:
+    raise ValueError("Unsupported data file format: %s" % input_file)
+
+
+def iter_qc_tsv(input_file):
+  """Lazily yields the (label, question) of each line of a QC file in data/.
+
+  The first line is a header and the others are "<coarse>:<fine> <question>",
+  returned as the label "<coarse>_<fine>" and the question.
+  """
+  if input_file.endswith((".gz", ".bz2")):
+    f = open_data_file(input_file)
+  else:
+    f = tf.gfile.Open(input_file, "r")
+  with f:
+    next(f, None)
+    for line in f:
+      split = line.rstrip("\r\n").split(" ", 1)
+      if len(split) == 2:
+        yield (split[0].replace(":", "_", 1),
+               tokenization.convert_to_unicode(split[1]))
+
+
+def read_qc_tsv(input_file, set_type, deduplicator=None, max_examples=None,
+                seed=0):
+  """Reads a QC file of data/ into an `ExampleTable` of one-label lists.
+
+  With a `Deduplicator`, the lines whose question duplicates one it has seen
+  are skipped as they are read. With `max_examples`, that many of the other
+  lines are drawn by `reservoir_sample` with `seed` as they are read, and
+  only those are stored. The guids number all the lines, so they do not
+  depend on which are skipped.
+  """
+  rows = ((i, label, text)
+          for (i, (label, text)) in enumerate(iter_qc_tsv(input_file))
+          if deduplicator is None or not deduplicator.is_duplicate(text))
+  if max_examples is not None:
+    rows = reservoir_sample(rows, max_examples, seed=seed)
+
+  guids = []
+  texts = []
+  labels = []
+  for (i, label, text) in rows:
+    guids.append("%s-%d" % (set_type, i))
+    texts.append(text)
+    labels.append([label])
+  return ExampleTable.from_columns(guids, texts, labels)
 
-# class QcFineProcessor(DataProcessor):
-#     """Processor for the MultiNLI data set (GLUE version)."""
-#
-#     def get_labeled_examples(self, data_dir):
-#         """See base class."""
-#         return self._create_examples(os.path.join(data_dir, "labeled.tsv"), "train")
-#
-#
-#     def get_unlabeled_examples(self, data_dir):
-#         """See base class."""
-#         return self._create_examples(os.path.join(data_dir, "unlabeled.tsv"), "train")
-#
-#     def get_test_examples(self, data_dir):
-#         """See base class."""
-#         return self._create_examples(os.path.join(data_dir, "test.tsv"), "test")
-#
-#     def get_labels(self):
-#         """See base class."""
-#         return ["UNK_UNK", "ABBR_abb", "ABBR_exp", "DESC_def", "DESC_desc", "DESC_manner", "DESC_reason", "ENTY_animal", "ENTY_body", "ENTY_color", "ENTY_cremat", "ENTY_currency", "ENTY_dismed", "ENTY_event", "ENTY_food", "ENTY_instru", "ENTY_lang", "ENTY_letter", "ENTY_other", "ENTY_plant", "ENTY_product", "ENTY_religion", "ENTY_sport", "ENTY_substance", "ENTY_symbol", "ENTY_techmeth", "ENTY_termeq", "ENTY_veh", "ENTY_word", "HUM_desc", "HUM_gr", "HUM_ind", "HUM_title", "LOC_city", "LOC_country", "LOC_mount", "LOC_other", "LOC_state", "NUM_code", "NUM_count", "NUM_date", "NUM_dist", "NUM_money", "NUM_ord", "NUM_other", "NUM_perc", "NUM_period", "NUM_speed", "NUM_temp", "NUM_volsize", "NUM_weight"]
-#
-#     def _create_examples(self, input_file, set_type):
-#         """Creates examples for the training and dev sets."""
-#         examples = []
-#
-#         with open(input_file, 'r') as f:
-#             contents = f.read()
-#             file_as_list = contents.splitlines()
-#             for line in file_as_list[1:]:
-#                 split = line.split(" ")
-#                 question = ' '.join(split[1:])
-#
-#                 guid = "%s-%s" % (set_type, tokenization.convert_to_unicode(line))
-#                 text_a = tokenization.convert_to_unicode(question)
-#                 inn_split = split[0].split(":")
-#                 label = inn_split[0] + "_" + inn_split[1]
-#                 examples.append(InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
-#             f.close()
-#
-#         return examples
 
 class QcFineProcessor(DataProcessor):
-    def __init__(self, train_data=None, unlabeled_train_data=None, test_data=None):
+    """Processor for the ProgrammerWeb multi-label catalog.
+
+    With `unlabeled_multiplier`, at most `unlabeled_multiplier` times as many
+    unlabeled examples as labeled ones are kept. As only 1% of the rows
+    (rounded down) are labeled, this trims the unlabeled split of catalogs
+    with fewer than about 100 * (1 + 1 / `unlabeled_multiplier`) rows, and
+    keeps no unlabeled example when there are fewer than 100 rows. The split
+    has its own fixed seed; `seed` is accepted like by the other processors
+    of `get_processor` but not used. With a `Deduplicator`, the rows whose
+    text duplicates an earlier row of the file are dropped while reading,
+    before the split.
+    """
+
+    def __init__(self, train_data=None, unlabeled_train_data=None, test_data=None,
+                 unlabeled_multiplier=None, seed=0, deduplicator=None):
         self.train_data = train_data
         self.unlabeled_train_data = unlabeled_train_data
         self.test_data = test_data
         self.labels = []
+        self.unlabeled_multiplier = unlabeled_multiplier
+        self.seed = seed
+        self.deduplicator = deduplicator
 
     def get_labeled_examples(self, data_dir):
         """See base class."""
@@ -154,65 +701,202 @@ class QcFineProcessor(DataProcessor):
         """See base class."""
         return self.labels
 
-    def _create_examples(self, input_file):
-
-        examples = []
-        tag_occurance = {}
+    def load_examples(self, data_dir, input_file=None):
+        """See base class. Reads `input_file`, the ProgrammerWeb CSV."""
+        if input_file is None:
+            raise ValueError("qc-fine reads the ProgrammerWeb CSV given as input_file.")
+        self._create_examples(input_file)
 
-        with open(input_file, newline='') as csvfile:
+    def _create_examples(self, input_file):
+        """Reads the ProgrammerWeb CSV and splits it into the three sets.
+
+        The file is read once, in full, since the tags are counted over
+        every row. Meanwhile the rows that can become examples are kept as
+        (id, text, tag ids), and the tags seen more than 100 times are
+        dropped afterwards. The examples are split 1% labeled / 89%
+        unlabeled / 10% test by a seeded permutation of their indices, into
+        three `ExampleTable`s. The unlabeled indices are already in random
+        order, so `unlabeled_multiplier` keeps the first ones, and only those
+        rows are converted. ".gz" and ".bz2" files are decompressed while
+        reading.
+        """
+        tag_ids = collections.OrderedDict()
+        tag_occurance = []
+        # The rows are stored flat: the tag ids of row i are
+        # row_tag_ids[row_ends[i - 1]:row_ends[i]]. Unlike a list per row,
+        # strings and ints are not tracked by the garbage collector.
+        guids = []
+        texts = []
+        row_tag_ids = []
+        row_ends = []
+
+        with open_data_file(input_file) as csvfile:
             reader = csv.reader(csvfile)
             next(reader)
             for row in reader:
 
                 if len(row) != 4:
                     continue
-                _, _, _, tag = row
+                id, title, dscp, tag = row
 
-                tag = tag.strip().split('###')
-                tag = [t for t in tag if t != '']
+                row_start = len(row_tag_ids)
+                for t in tag.strip().split('###'):
+                    if t == '':
+                        continue
+                    t_id = tag_ids.get(t)
+                    if t_id is None:
+                        t_id = tag_ids[t] = len(tag_occurance)
+                        # Counts start at 1, so a tag seen n times counts n + 1.
+                        tag_occurance.append(1)
+                    tag_occurance[t_id] += 1
+                    row_tag_ids.append(t_id)
 
-                for t in tag:
-                    if t not in tag_occurance:
-                        tag_occurance[t] = 1
-                    tag_occurance[t] += 1
+                text_a = tokenization.convert_to_unicode(title + dscp)
+                if (len(text_a) > 510 or len(row_tag_ids) == row_start or
+                        (self.deduplicator is not None and
+                         self.deduplicator.is_duplicate(text_a))):
+                    del row_tag_ids[row_start:]
+                    continue
+                guids.append(id)
+                texts.append(text_a)
+                row_ends.append(len(row_tag_ids))
+
+        tag_names = list(tag_ids)
+        is_kept = [count <= 100 for count in tag_occurance]
+        self.labels.extend(t for t, kept in zip(tag_names, is_kept) if kept)
+
+        # Rows left with at least one tag once the frequent ones are dropped.
+        rows = []
+        row_start = 0
+        for i, row_end in enumerate(row_ends):
+            for t_id in row_tag_ids[row_start:row_end]:
+                if is_kept[t_id]:
+                    rows.append(i)
+                    break
+            row_start = row_end
+
+        ind = np.random.RandomState(seed=10).permutation(len(rows))
+        split = int(len(rows) * 0.01)
+        split2 = int(len(rows) * 0.9)
+
+        def get_tags(i):
+            row_start = row_ends[i - 1] if i > 0 else 0
+            return [tag_names[t_id]
+                    for t_id in row_tag_ids[row_start:row_ends[i]]
+                    if is_kept[t_id]]
+
+        unlabeled_ind = ind[split:split2]
+        if self.unlabeled_multiplier:
+            unlabeled_ind = unlabeled_ind[:self.unlabeled_multiplier * split]
+
+        def create_examples(indices):
+            return ExampleTable.from_columns(
+                guids=[guids[rows[j]] for j in indices],
+                texts_a=[texts[rows[j]] for j in indices],
+                labels=[get_tags(rows[j]) for j in indices])
+
+        self.train_data = create_examples(ind[:split])
+        self.unlabeled_train_data = create_examples(unlabeled_ind)
+        self.test_data = create_examples(ind[split2:])
+
+
+# The fine-grained classes of the QC data set, plus UNK_UNK for the unlabeled
+# examples.
+QC_FINE_LABELS = ["UNK_UNK", "ABBR_abb", "ABBR_exp", "DESC_def", "DESC_desc", "DESC_manner", "DESC_reason", "ENTY_animal", "ENTY_body", "ENTY_color", "ENTY_cremat", "ENTY_currency", "ENTY_dismed", "ENTY_event", "ENTY_food", "ENTY_instru", "ENTY_lang", "ENTY_letter", "ENTY_other", "ENTY_plant", "ENTY_product", "ENTY_religion", "ENTY_sport", "ENTY_substance", "ENTY_symbol", "ENTY_techmeth", "ENTY_termeq", "ENTY_veh", "ENTY_word", "HUM_desc", "HUM_gr", "HUM_ind", "HUM_title", "LOC_city", "LOC_country", "LOC_mount", "LOC_other", "LOC_state", "NUM_code", "NUM_count", "NUM_date", "NUM_dist", "NUM_money", "NUM_ord", "NUM_other", "NUM_perc", "NUM_period", "NUM_speed", "NUM_temp", "NUM_volsize", "NUM_weight"]
+
+
+class QcTsvProcessor(DataProcessor):
+    """Processor for the QC files bundled in data/.
+
+    labeled.tsv, unlabeled.tsv and test.tsv are read once, concurrently, into
+    `ExampleTable`s whose labels are one-label lists like ["NUM_count"]. With
+    `unlabeled_multiplier`, at most that many times as many unlabeled
+    examples as labeled ones are kept, drawn by `reservoir_sample` with
+    `seed` while unlabeled.tsv is read, so only those are stored. With a
+    `Deduplicator`, the labeled and then the unlabeled examples whose text
+    duplicates an earlier one are skipped while reading, before the
+    sampling; the test examples are all kept.
+    """
 
-        ignored_tags = set()
-        for tag in tag_occurance:
-            if tag_occurance[tag] > 100:
-                ignored_tags.add(tag)
+    SET_FILES = collections.OrderedDict([("labeled", "labeled.tsv"),
+                                         ("unlabeled", "unlabeled.tsv"),
+                                         ("test", "test.tsv")])
+
+    def __init__(self, unlabeled_multiplier=None, seed=0, deduplicator=None):
+        self.unlabeled_multiplier = unlabeled_multiplier
+        self.seed = seed
+        self.deduplicator = deduplicator
+        self.examples = None
+
+    def load_examples(self, data_dir, input_file=None):
+        """See base class. Reads the three files of `data_dir`."""
+        if self.deduplicator is None and not self.unlabeled_multiplier:
+            groups = [[set_type] for set_type in self.SET_FILES]
+        else:
+            # The unlabeled examples are read after the labeled ones, which
+            # the deduplicator must see first and which set the sample size.
+            groups = [["labeled", "unlabeled"], ["test"]]
+        # Reading is mostly I/O on remote file systems, which threads overlap;
+        # the files are too small to pay for worker processes.
+        pool = ThreadPool(processes=len(groups))
+        try:
+            tables = pool.map(
+                lambda group: self._read_sets(data_dir, group), groups)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.examples = dict(zip(itertools.chain.from_iterable(groups),
+                                 itertools.chain.from_iterable(tables)))
+
+    def _read_sets(self, data_dir, set_types):
+        """Reads the files of `set_types`, in order, into a list of tables."""
+        tables = collections.OrderedDict()
+        for set_type in set_types:
+            input_file = os.path.join(data_dir, self.SET_FILES[set_type])
+            if set_type == "test":
+                tables[set_type] = read_qc_tsv(input_file, set_type)
+            elif set_type == "unlabeled" and self.unlabeled_multiplier:
+                tables[set_type] = read_qc_tsv(
+                    input_file, set_type, self.deduplicator,
+                    max_examples=(self.unlabeled_multiplier *
+                                  len(tables["labeled"])),
+                    seed=self.seed)
             else:
-                self.labels.append(tag)
-
-        with open(input_file, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)
-            for row in reader:
+                tables[set_type] = read_qc_tsv(input_file, set_type,
+                                               self.deduplicator)
+        return list(tables.values())
 
-                if len(row) != 4:
-                    continue
-                id, title, dscp, tag = row
+    def _get_examples(self, data_dir, set_type):
+        if self.examples is None:
+            self.load_examples(data_dir)
+        return self.examples[set_type]
 
-                text_a = tokenization.convert_to_unicode(title + dscp)
+    def get_labeled_examples(self, data_dir):
+        """See base class."""
+        return self._get_examples(data_dir, "labeled")
 
-                if len(text_a) > 510:
-                    continue
+    def get_unlabeled_examples(self, data_dir):
+        """See base class."""
+        return self._get_examples(data_dir, "unlabeled")
 
-                tag = tag.strip().split('###')
-                tag = [t for t in tag if t != '']
+    def get_test_examples(self, data_dir):
+        """See base class."""
+        return self._get_examples(data_dir, "test")
 
-                if ignored_tags is not None:
-                    tag = [t for t in tag if t not in ignored_tags]
+    def get_labels(self):
+        """See base class."""
+        return QC_FINE_LABELS
 
-                if len(tag) == 0:
-                    continue
 
-                examples.append(InputExample(guid=id, text_a=text_a, text_b=None, label=tag))
+PROCESSORS = collections.OrderedDict([
+    ("qc-fine", QcFineProcessor),
+    ("qc-tsv", QcTsvProcessor),
+])
 
-        examples = np.array(examples)
-        ind = np.random.RandomState(seed=10).permutation(len(examples))
-        split = int(len(examples) * 0.01)
-        split2 = int(len(examples) * 0.9)
-        self.train_data = examples[ind[:split]].tolist()
-        self.unlabeled_train_data = examples[ind[split:split2]].tolist()
-        self.test_data = examples[ind[split2:]].tolist()
 
+def get_processor(task_name, **kwargs):
+  """Returns the processor registered for `task_name` in `PROCESSORS`."""
+  task_name = task_name.lower()
+  if task_name not in PROCESSORS:
+    raise ValueError("Task not found: %s" % (task_name))
+  return PROCESSORS[task_name](**kwargs)
@@ -0,0 +1,347 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Copyright Tor Vergata, University of Rome. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Feature store of memory-mapped NumPy arrays, an alternative to TFRecord files
+# for datasets that fit on local disk
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import numpy as np
+import six
+import tensorflow as tf
+
+# Bump when the layout of the stored arrays changes.
+STORE_FORMAT_VERSION = 1
+
+# Extension of the store directories.
+STORE_EXTENSION = ".npy_features"
+
+_METADATA_FILE = "metadata.json"
+
+# The sequence features, which are stored as the token ids plus the lengths
+# they are rebuilt from.
+_SEQUENCE_FEATURES = ["input_ids", "input_mask", "segment_ids"]
+
+
+def get_token_dtype(vocab_size):
+  """Smallest dtype holding the ids of a vocabulary of `vocab_size` tokens."""
+  if vocab_size <= np.iinfo(np.uint16).max + 1:
+    return "uint16"
+  return "int32"
+
+
+class FeatureStoreWriter(object):
+  """Writes feature arrays to a store directory of .npy files.
+
+  `write` takes the arrays of consecutive examples, as returned by e.g.
+  `ganbert.convert_examples_to_feature_arrays`: "input_ids", "input_mask" and
+  "segment_ids" of shape [N, max_seq_length] plus any other per-example
+  features. Only the token ids are kept of the sequence features, in
+  `token_dtype`, with the number of real tokens in "lengths" and the length of
+  the first segment in "lengths_a". The other features are stored with the
+  dtype given in `dtypes`, int32 by default.
+
+  The arrays are allocated for `num_examples` rows when the first chunk is
+  written; `close` writes the metadata that makes the store readable.
+  """
+
+  def __init__(self, store_dir, num_examples, token_dtype, dtypes=None):
+    self.store_dir = store_dir
+    self.num_examples = num_examples
+    self.token_dtype = token_dtype
+    self.dtypes = dtypes or {}
+    self._arrays = None
+    self._position = 0
+    self._seq_length = None
+
+  def _create_arrays(self, arrays):
+    tf.gfile.MakeDirs(self.store_dir)
+    self._seq_length = arrays["input_ids"].shape[1]
+    shapes = collections.OrderedDict()
+    shapes["input_ids"] = ([self._seq_length], self.token_dtype)
+    shapes["lengths"] = ([], "int32")
+    shapes["lengths_a"] = ([], "int32")
+    for name, values in arrays.items():
+      if name not in _SEQUENCE_FEATURES:
+        shapes[name] = (list(values.shape[1:]), self.dtypes.get(name, "int32"))
+
+    self._arrays = collections.OrderedDict()
+    for name, (shape, dtype) in shapes.items():
+      self._arrays[name] = np.lib.format.open_memmap(
+          os.path.join(self.store_dir, name + ".npy"), mode="w+",
+          dtype=np.dtype(dtype), shape=tuple([self.num_examples] + shape))
+
+  def write(self, arrays):
+    """Writes the features of the next `len(arrays["input_ids"])` examples."""
+    if self._arrays is None:
+      self._create_arrays(arrays)
+    start = self._position
+    end = start + len(arrays["input_ids"])
+    if end > self.num_examples:
+      raise ValueError("More than %d examples written to %s" %
+                       (self.num_examples, self.store_dir))
+
+    lengths = arrays["input_mask"].sum(axis=1)
+    self._arrays["input_ids"][start:end] = arrays["input_ids"]
+    self._arrays["lengths"][start:end] = lengths
+    self._arrays["lengths_a"][start:end] = (
+        lengths - arrays["segment_ids"].sum(axis=1))
+    for name, values in arrays.items():
+      if name not in _SEQUENCE_FEATURES:
+        self._arrays[name][start:end] = values
+    self._position = end
+
+  def close(self):
+    if self._position != self.num_examples:
+      raise ValueError("%d of %d examples written to %s" %
+                       (self._position, self.num_examples, self.store_dir))
+    tf.gfile.MakeDirs(self.store_dir)
+    metadata = collections.OrderedDict()
+    metadata["version"] = STORE_FORMAT_VERSION
+    metadata["num_examples"] = self.num_examples
+    metadata["seq_length"] = self._seq_length
+    metadata["features"] = list(self._arrays or [])
+    for array in (self._arrays or {}).values():
+      array.flush()
+    self._arrays = None
+    with tf.gfile.GFile(os.path.join(self.store_dir, _METADATA_FILE),
+                        "w") as writer:
+      json.dump(metadata, writer, indent=2)
+
+
+class FeatureStore(object):
+  """Reads one or more store directories as a single sequence of examples.
+
+  The arrays are memory-mapped, so opening a store is cheap and `get_rows`
+  only touches the rows it returns.
+  """
+
+  def __init__(self, store_dirs):
+    if isinstance(store_dirs, six.string_types):
+      store_dirs = [store_dirs]
+    self.store_dirs = list(store_dirs)
+    self._stores = []
+    for store_dir in self.store_dirs:
+      with tf.gfile.GFile(os.path.join(store_dir, _METADATA_FILE),
+                          "r") as reader:
+        metadata = json.load(reader)
+      if metadata["version"] != STORE_FORMAT_VERSION:
+        raise ValueError("Unsupported feature store version %d in %s" %
+                         (metadata["version"], store_dir))
+      # A store written without any example has no arrays.
+      if not metadata["num_examples"]:
+        continue
+      self._stores.append(collections.OrderedDict(
+          (name, np.load(os.path.join(store_dir, name + ".npy"),
+                         mmap_mode="r"))
+          for name in metadata["features"]))
+    self._offsets = np.cumsum([0] + [len(store["lengths"])
+                                     for store in self._stores])
+    self.feature_shapes = collections.OrderedDict()
+    first_store = self._stores[0] if self._stores else {}
+    for name, array in first_store.items():
+      if name in ["lengths", "lengths_a"]:
+        continue
+      self.feature_shapes[name] = list(array.shape[1:])
+      if name == "input_ids":
+        self.feature_shapes["input_mask"] = list(array.shape[1:])
+        self.feature_shapes["segment_ids"] = list(array.shape[1:])
+
+  def __len__(self):
+    return int(self._offsets[-1])
+
+  def get_rows(self, start, end):
+    """Returns the features of examples [start, end) as int32 arrays.
+
+    Slices of a single store are views of the memory-mapped arrays; the only
+    copy is the conversion to int32.
+    """
+    pieces = []
+    for i, store in enumerate(self._stores):
+      store_start = max(start, self._offsets[i]) - self._offsets[i]
+      store_end = min(end, self._offsets[i + 1]) - self._offsets[i]
+      if store_start < store_end:
+        pieces.append(collections.OrderedDict(
+            (name, array[store_start:store_end])
+            for name, array in store.items()))
+    if not pieces:
+      rows = collections.OrderedDict(
+          (name, array[:0]) for name, array in self._stores[0].items())
+    elif len(pieces) == 1:
+      rows = pieces[0]
+    else:
+      rows = collections.OrderedDict(
+          (name, np.concatenate([piece[name] for piece in pieces]))
+          for name in self._stores[0])
+    return _expand_rows(rows)
+
+  def take_rows(self, indices):
+    """Returns the features of the examples at `indices` as int32 arrays.
+
+    The rows are returned in increasing index order, which keeps the reads of
+    the memory-mapped arrays sequential.
+    """
+    indices = np.sort(indices)
+    store_ids = np.searchsorted(self._offsets, indices, side="right") - 1
+    pieces = []
+    for i, store in enumerate(self._stores):
+      store_indices = indices[store_ids == i] - self._offsets[i]
+      if len(store_indices):
+        pieces.append(collections.OrderedDict(
+            (name, array[store_indices]) for name, array in store.items()))
+    if not pieces:
+      return self.get_rows(0, 0)
+    return _expand_rows(_concatenate_rows(pieces))
+
+
+class _EpochSampler(object):
+  """Endless stream of the row indices of a store, shuffled every epoch.
+
+  Position `p` of the stream is row `permutation(p // num_rows)[p % num_rows]`
+  where each epoch draws its own permutation from `seed`, so every row is
+  seen exactly once per epoch and any range of the stream can be computed
+  independently of the others.
+  """
+
+  def __init__(self, num_rows, seed):
+    self.num_rows = num_rows
+    self.seed = seed
+    self._permutations = {}
+
+  def _get_permutation(self, epoch):
+    permutation = self._permutations.get(epoch)
+    if permutation is None:
+      permutation = np.random.RandomState(
+          self.seed + [epoch]).permutation(self.num_rows)
+      # Batches are requested roughly in order, so only the permutations of
+      # the current and the previous epoch are worth keeping.
+      for old_epoch in list(self._permutations):
+        if old_epoch < epoch - 1:
+          self._permutations.pop(old_epoch, None)
+      self._permutations[epoch] = permutation
+    return permutation
+
+  def get_indices(self, start, end):
+    """Returns the row indices at positions [start, end) of the stream."""
+    pieces = [np.zeros([0], dtype=np.int64)]
+    while start < end:
+      epoch, offset = divmod(start, self.num_rows)
+      num_rows = min(end - start, self.num_rows - offset)
+      pieces.append(self._get_permutation(epoch)[offset:offset + num_rows])
+      start += num_rows
+    return np.concatenate(pieces)
+
+
+def _expand_rows(rows):
+  """Rebuilds input_mask and segment_ids and casts every feature to int32."""
+  features = collections.OrderedDict()
+  input_ids = rows["input_ids"]
+  positions = np.arange(input_ids.shape[1])[np.newaxis, :]
+  input_mask = positions < rows["lengths"][:, np.newaxis]
+  features["input_ids"] = input_ids.astype(np.int32)
+  features["input_mask"] = input_mask.astype(np.int32)
+  features["segment_ids"] = (
+      input_mask & (positions >= rows["lengths_a"][:, np.newaxis])).astype(
+          np.int32)
+  for name, values in rows.items():
+    if name not in ["input_ids", "lengths", "lengths_a"]:
+      features[name] = values.astype(np.int32)
+  return features
+
+
+def _concatenate_rows(pieces):
+  if len(pieces) == 1:
+    return pieces[0]
+  return collections.OrderedDict(
+      (name, np.concatenate([piece[name] for piece in pieces]))
+      for name in pieces[0])
+
+
+def input_fn_builder(store_dirs, is_training, drop_remainder, batch_size=None,
+                     labeled_store_dirs=None, labeled_weight=None, seed=0):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  Batches are sliced out of the memory-mapped arrays by `tf.py_func`s mapped
+  over batch numbers, several at a time. For eval and predict the examples
+  are returned in order. For training, the rows are drawn without
+  replacement from a new permutation of the store every epoch, see
+  `_EpochSampler`, so the order the examples were written in does not
+  matter. With `labeled_store_dirs`, a `labeled_weight` share of every batch
+  comes from the labeled store, which has its own epochs; batch `i` holds
+  the labeled examples at positions [floor(i * batch_size * labeled_weight),
+  floor((i + 1) * batch_size * labeled_weight)) of that stream. Batch `i`
+  only depends on `seed` and `i`.
+
+  `batch_size` defaults to `params["batch_size"]`.
+  """
+  if labeled_store_dirs and not is_training:
+    raise ValueError("Labeled stores are only sampled when training.")
+
+  def input_fn(params):
+    """The actual input function."""
+    size = batch_size or params["batch_size"]
+    store = FeatureStore(store_dirs)
+    labeled_store = None
+    if labeled_store_dirs:
+      labeled_store = FeatureStore(labeled_store_dirs)
+    names = list(store.feature_shapes)
+    if is_training:
+      for train_store in [store, labeled_store]:
+        if train_store is not None and not len(train_store):
+          raise ValueError("Cannot draw training batches from the empty "
+                           "feature store %s" %
+                           ", ".join(train_store.store_dirs))
+      sampler = _EpochSampler(len(store), [seed, 0])
+      if labeled_store is not None:
+        labeled_sampler = _EpochSampler(len(labeled_store), [seed, 1])
+
+    def get_eval_batch(batch):
+      start = batch * size
+      rows = store.get_rows(start, min(start + size, len(store)))
+      return [rows[name] for name in names]
+
+    def get_train_batch(batch):
+      start = batch * size
+      end = start + size
+      pieces = []
+      if labeled_store is not None:
+        labeled_start = int(start * labeled_weight)
+        labeled_end = int(end * labeled_weight)
+        pieces.append(labeled_store.take_rows(
+            labeled_sampler.get_indices(labeled_start, labeled_end)))
+        start -= labeled_start
+        end -= labeled_end
+      pieces.append(store.take_rows(sampler.get_indices(start, end)))
+      rows = _concatenate_rows(pieces)
+      return [rows[name] for name in names]
+
+    if is_training:
+      d = tf.data.Dataset.range(np.iinfo(np.int64).max)
+      get_batch = get_train_batch
+    else:
+      if drop_remainder:
+        num_batches = len(store) // size
+      else:
+        num_batches = (len(store) + size - 1) // size
+      d = tf.data.Dataset.range(num_batches)
+      get_batch = get_eval_batch
+    static_size = size if drop_remainder or is_training else None
+
+    def load_batch(batch):
+      features = tf.py_func(get_batch, [batch], [tf.int32] * len(names))
+      example = collections.OrderedDict()
+      for name, feature in zip(names, features):
+        feature.set_shape([static_size] + store.feature_shapes[name])
+        example[name] = feature
+      return example
+
+    d = d.map(load_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return d.prefetch(tf.data.experimental.AUTOTUNE)
+
+  return input_fn
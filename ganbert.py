@@ -9,19 +9,25 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
 import collections
 import csv
+import hashlib
+import json
+import multiprocessing
 import os
 import modeling
 import optimization
 import tokenization
+import tokenization_cache
+import feature_store
 import tensorflow as tf
 import numpy as np
 import random
 import math
 import tf_metrics
 
-from data_processors import InputFeatures, PaddingInputExample, QcFineProcessor
+from data_processors import Deduplicator, ExampleTable, InputFeatures, PaddingInputExample, get_processor, take_examples
 
 
 flags = tf.flags
@@ -30,7 +36,10 @@ FLAGS = flags.FLAGS
 
 flags.DEFINE_integer(
     "unlabeled_multiplier", 100,
-    "The multiplier to compute the max number of unlabeled examples with respect to the labeled examples.")
+    "The multiplier to compute the max number of unlabeled examples with respect to the labeled examples. "
+    "The unlabeled examples are randomly sampled down to that number, "
+    "deterministically for a given seed. 0 keeps all of them. Every input "
+    "file is still read in full.")
 
 flags.DEFINE_string(
     "data_dir", None,
@@ -42,7 +51,28 @@ flags.DEFINE_string(
     "The config json file corresponding to the pre-trained BERT model. "
     "This specifies the model architecture.")
 
-flags.DEFINE_string("task_name", None, "The name of the task to train.")
+flags.DEFINE_string("task_name", None,
+                    "The name of the task to train, a key of "
+                    "`data_processors.PROCESSORS`: qc-fine for the "
+                    "ProgrammerWeb CSV given as --input_file, or qc-tsv "
+                    "for the QC files in --data_dir.")
+
+flags.DEFINE_string(
+    "input_file", "../../datasets/multiLabel_text_classification/ProgrammerWeb/programweb-data.csv",
+    "Data file of the tasks reading a single file, such as the ProgrammerWeb "
+    "CSV of qc-fine. May be compressed with gzip or bzip2.")
+
+flags.DEFINE_enum(
+    "dedup_mode", "none", ["none", "exact", "near"],
+    "Duplicate examples dropped while loading: none, \"exact\" for texts "
+    "equal once case-folded and stripped of punctuation, or \"near\" to "
+    "also drop the texts close to a kept one by MinHash, see "
+    "`data_processors.Deduplicator`.")
+
+flags.DEFINE_float(
+    "near_duplicate_threshold", 0.8,
+    "Estimated Jaccard similarity of character 5-grams above which "
+    "--dedup_mode=near drops a text.")
 
 flags.DEFINE_string("vocab_file", None,
                     "The vocabulary file that the BERT model was trained on.")
@@ -60,6 +90,82 @@ flags.DEFINE_bool(
     "Whether to lower case the input text. Should be True for uncased "
     "models and False for cased models.")
 
+flags.DEFINE_integer(
+    "tokenizer_cache_size", 100000,
+    "Number of distinct words whose WordPiece tokenization is memoized in an "
+    "LRU cache. Set to 0 to disable the cache.")
+
+flags.DEFINE_integer(
+    "tokenize_num_workers", 1,
+    "Number of processes used to tokenize the examples.")
+
+flags.DEFINE_integer(
+    "num_record_shards", 1,
+    "Number of TFRecord shards the features are written to, each by its own "
+    "process. With 1, a single file is written by the main process.")
+
+flags.DEFINE_enum(
+    "record_format", "compact", ["padded", "compact", "npy"],
+    "Layout of the feature records. `padded` stores input_ids, input_mask and "
+    "segment_ids padded to max_seq_length and multi-hot label_ids; `compact` "
+    "stores only the token ids as packed bytes and the label indices, and "
+    "rebuilds the rest in the input pipeline. `npy` writes memory-mapped NumPy "
+    "arrays instead of TFRecord files, see feature_store.py; length bucketing "
+    "does not apply to it.")
+
+flags.DEFINE_list(
+    "bucket_boundaries", [],
+    "[Optional] Comma separated sequence lengths, e.g. 16,32,64. When set, "
+    "examples are batched with others of similar length and every batch is "
+    "padded to its bucket instead of max_seq_length. Ignored on TPU, which "
+    "needs fixed shapes.")
+
+flags.DEFINE_integer(
+    "max_tokens_per_batch", 0,
+    "[Optional] When positive, training and eval batches hold as many "
+    "examples as fit in this many padded tokens instead of a fixed number. "
+    "Implies length bucketing, with --bucket_boundaries or powers of two. "
+    "The number of training steps is then derived from the number of "
+    "batches the written records fill instead of train_batch_size. Ignored "
+    "on TPU and with --record_format=npy.")
+
+flags.DEFINE_enum(
+    "oversampling_mode", "sample", ["duplicate", "sample"],
+    "How labeled examples are oversampled when label_rate < 1. `duplicate` "
+    "writes every labeled record several times; `sample` writes it once, to "
+    "separate files, and draws from the labeled and unlabeled records with "
+    "--labeled_sampling_weight during training.")
+
+flags.DEFINE_float(
+    "labeled_sampling_weight", 0.0,
+    "[Optional] Probability that a training example is drawn from the labeled "
+    "records with --oversampling_mode=sample. By default, the share of labeled "
+    "records `duplicate` would have written.")
+
+flags.DEFINE_integer(
+    "input_num_parallel_reads", 4,
+    "Number of record files read concurrently during training.")
+
+flags.DEFINE_integer(
+    "input_num_parallel_calls", -1,
+    "Number of batches of records parsed in parallel. -1 lets tf.data tune "
+    "it.")
+
+flags.DEFINE_integer(
+    "input_prefetch_batches", -1,
+    "Number of batches prepared ahead of the model. -1 lets tf.data tune it, "
+    "0 disables prefetching.")
+
+flags.DEFINE_bool(
+    "reuse_features", True,
+    "Whether to reuse the feature records already in output_dir when they "
+    "were written from the same examples, vocabulary and settings.")
+
+flags.DEFINE_string(
+    "tokenization_cache_dir", None,
+    "[Optional] Directory of a persistent cache of tokenized texts, keyed by "
+    "text, vocabulary and casing, that is reused across runs.")
+
 flags.DEFINE_integer(
     "max_seq_length", 500,##128,
     "The maximum total input sequence length after WordPiece tokenization. "
@@ -132,6 +238,21 @@ epsilon = 1e-8
 DKP = FLAGS.dropout_keep_rate
 LATENT_Z = 100
 
+# Number of examples converted to feature arrays at a time.
+CONVERT_CHUNK_SIZE = 4096
+
+# Bump when the written feature records change, so that cached ones are
+# rewritten.
+FEATURES_FORMAT_VERSION = 2
+
+# Dtypes of the features stored with --record_format=npy, besides the token
+# ids. Labels are multi-hot and the masks are flags.
+NPY_FEATURE_DTYPES = {
+    "label_ids": "uint8",
+    "label_mask": "uint8",
+    "is_real_example": "uint8",
+}
+
 SEED = 0
 np.random.seed(SEED)
 tf.compat.v1.set_random_seed(SEED)
@@ -141,183 +262,706 @@ random.seed(SEED)
 def convert_single_example(ex_index, example, label_list, max_seq_length,
                            tokenizer, label_mask):
   """Converts a single `InputExample` into a single `InputFeatures`."""
+  arrays = convert_examples_to_feature_arrays(
+      [example], create_label_map(label_list), max_seq_length, tokenizer,
+      [label_mask])
+
+  feature = InputFeatures(
+      input_ids=arrays["input_ids"][0],
+      input_mask=arrays["input_mask"][0],
+      segment_ids=arrays["segment_ids"][0],
+      label_id=arrays["label_ids"][0],
+      label_mask=label_mask,
+      is_real_example=bool(arrays["is_real_example"][0]))
+  return feature
 
-  if isinstance(example, PaddingInputExample):
-    return InputFeatures(
-        input_ids=[0] * max_seq_length,
-        input_mask=[0] * max_seq_length,
-        segment_ids=[0] * max_seq_length,
-        label_id=0,
-        label_mask=label_mask,
-        is_real_example=False)
 
+def create_label_map(label_list):
+  """Maps every label to its index in `label_list`."""
   label_map = {}
   for (i, label) in enumerate(label_list):
     label_map[label] = i
-
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
-
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
-    # length is less than the specified length.
-    # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+  return label_map
+
+
+def convert_examples_to_feature_arrays(examples, label_map, max_seq_length,
+                                       tokenizer, label_masks, num_workers=1):
+  """Converts a chunk of `InputExample`s into stacked feature arrays.
+
+  Args:
+    examples: Sequence of N `InputExample`s or `PaddingInputExample`s, or an
+      `ExampleTable` of N rows.
+    label_map: Dict from label to index, see `create_label_map`.
+    max_seq_length: Length every sequence is padded or truncated to.
+    tokenizer: The `FullTokenizer`.
+    label_masks: Sequence of N booleans, True for labeled examples.
+    num_workers: Number of tokenization processes.
+
+  Returns:
+    An OrderedDict from the TFRecord feature names to arrays: "input_ids",
+    "input_mask" and "segment_ids" of shape [N, max_seq_length], the
+    multi-hot "label_ids" of shape [N, num_labels], and "label_mask" and
+    "is_real_example" of shape [N]. Padding examples get all-zero rows.
+  """
+  num_examples = len(examples)
+  if isinstance(examples, ExampleTable):
+    real_indices = np.flatnonzero(examples.is_real)
+    real_examples = examples.take(real_indices)
+    texts_a = real_examples.get_texts_a()
+    texts_b = real_examples.get_texts_b()
+  else:
+    real_indices = [i for i, example in enumerate(examples)
+                    if not isinstance(example, PaddingInputExample)]
+    real_examples = [examples[i] for i in real_indices]
+    texts_a = [example.text_a for example in real_examples]
+    texts_b = [example.text_b for example in real_examples]
+
+  # See `FullTokenizer.encode` for the [CLS]/[SEP] and segment id layout.
+  input_ids, input_mask, segment_ids = tokenizer.encode_batch(
+      texts_a, texts_b, max_seq_length, num_workers=num_workers)
+  if len(real_indices) != num_examples:
+    shape = [num_examples, max_seq_length]
+    arrays = [np.zeros(shape, dtype=np.int32) for _ in range(3)]
+    for array, real_rows in zip(arrays, [input_ids, input_mask, segment_ids]):
+      array[real_indices] = real_rows
+    input_ids, input_mask, segment_ids = arrays
+
+  label_ids = np.zeros([num_examples, len(label_map)], dtype=np.int64)
+  if isinstance(examples, ExampleTable):
+    label_rows, label_columns = real_examples.get_label_coordinates(label_map)
+    label_rows = real_indices[label_rows]
   else:
-    # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-  # The convention in BERT is:
-  # (a) For sequence pairs:
-  #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-  #  type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
-  # (b) For single sequences:
-  #  tokens:   [CLS] the dog is hairy . [SEP]
-  #  type_ids: 0     0   0   0  0     0 0
-  #
-  # Where "type_ids" are used to indicate whether this is the first
-  # sequence or the second sequence. The embedding vectors for `type=0` and
-  # `type=1` were learned during pre-training and are added to the wordpiece
-  # embedding vector (and position vector). This is not *strictly* necessary
-  # since the [SEP] token unambiguously separates the sequences, but it makes
-  # it easier for the model to learn the concept of sequences.
-  #
-  # For classification tasks, the first vector (corresponding to [CLS]) is
-  # used as the "sentence vector". Note that this only makes sense because
-  # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-  # The mask has 1 for real tokens and 0 for padding tokens. Only real
-  # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
-
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
-
-  label_id = np.zeros([len(label_list)], dtype=np.int64)
-  for t in example.label:
-      label_id[label_map[t]] = 1.
-
-  # if ex_index < 5:
-  #   tf.logging.info("*** Example ***")
-  #   tf.logging.info("guid: %s" % (example.guid))
-  #   tf.logging.info("tokens: %s" % " ".join(
-  #       [tokenization.printable_text(x) for x in tokens]))
-  #   tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-  #   tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-  #   tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-  #   tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
+    label_rows = []
+    label_columns = []
+    for i, example in zip(real_indices, real_examples):
+      for t in example.label:
+        label_rows.append(i)
+        label_columns.append(label_map[t])
+  label_ids[label_rows, label_columns] = 1
+
+  is_real_example = np.zeros([num_examples], dtype=np.int64)
+  is_real_example[real_indices] = 1
+
+  arrays = collections.OrderedDict()
+  arrays["input_ids"] = input_ids
+  arrays["input_mask"] = input_mask
+  arrays["segment_ids"] = segment_ids
+  arrays["label_ids"] = label_ids
+  arrays["label_mask"] = np.asarray(label_masks, dtype=np.int64)
+  arrays["is_real_example"] = is_real_example
+  return arrays
+
+
+def create_tf_examples(arrays):
+  """Yields one `tf.train.Example` per row of `convert_examples_to_feature_arrays`."""
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  num_examples = len(arrays["is_real_example"])
+  for i in range(num_examples):
+    features = collections.OrderedDict()
+    for name, values in arrays.items():
+      if values.ndim == 1:
+        features[name] = create_int_feature([values[i]])
+      else:
+        features[name] = create_int_feature(values[i])
+    yield tf.train.Example(features=tf.train.Features(feature=features))
 
-  feature = InputFeatures(
-      input_ids=input_ids,
-      input_mask=input_mask,
-      segment_ids=segment_ids,
-      label_id=label_id,
-      label_mask=label_mask,
-      is_real_example=True)
-  return feature
 
+def get_token_dtype(tokenizer):
+  """Smallest dtype holding every token id, used by compact records."""
+  return feature_store.get_token_dtype(len(tokenizer.inv_vocab))
 
-def file_based_convert_examples_to_features(
-    labeled_examples, unlabeled_examples, label_list, max_seq_length, tokenizer, output_file, label_mask_rate, is_testing=False):
-  """Convert a set of `InputExample`s to a TFRecord file."""
-  all_examples = labeled_examples
-  if unlabeled_examples:
-    all_examples = all_examples + unlabeled_examples
-  label_masks = get_labeled_mask(mask_size=len(all_examples), labeled_size=len(labeled_examples))
 
-  to_write_examples = list()
-  for ex_index, example in enumerate(all_examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d" % ex_index)
-    feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer, label_masks[ex_index])
+def create_compact_tf_examples(arrays, token_dtype):
+  """Yields compact `tf.train.Example`s for `convert_examples_to_feature_arrays`.
+
+  Only the real tokens are stored, as little-endian `token_dtype` bytes in
+  "token_ids", with the length of the first segment, [CLS] and [SEP]
+  included, in "length_a". "label_ids" holds the indices of the labels
+  instead of a multi-hot vector. `file_based_input_fn_builder` turns the
+  records back into the padded features.
+  """
 
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
 
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
+  lengths = arrays["input_mask"].sum(axis=1)
+  lengths_a = lengths - arrays["segment_ids"].sum(axis=1)
+  token_ids = arrays["input_ids"].astype(np.dtype(token_dtype).newbyteorder("<"))
+  label_rows, label_columns = np.nonzero(arrays["label_ids"])
+  label_starts = np.searchsorted(label_rows, np.arange(len(lengths) + 1))
 
+  for i in range(len(lengths)):
     features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(feature.input_ids)
-    features["input_mask"] = create_int_feature(feature.input_mask)
-    features["segment_ids"] = create_int_feature(feature.segment_ids)
-    features["label_ids"] = create_int_feature(feature.label_id)
-    features["label_mask"] = create_int_feature([feature.label_mask])
+    features["token_ids"] = tf.train.Feature(bytes_list=tf.train.BytesList(
+        value=[token_ids[i, :lengths[i]].tobytes()]))
+    features["length_a"] = create_int_feature([lengths_a[i]])
+    features["label_ids"] = create_int_feature(
+        label_columns[label_starts[i]:label_starts[i + 1]])
+    features["label_mask"] = create_int_feature([arrays["label_mask"][i]])
     features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
+        [arrays["is_real_example"][i]])
+    yield tf.train.Example(features=tf.train.Features(feature=features))
 
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
 
-    if label_mask_rate == 1:
-        to_write_examples.append(tf_example)
+def file_based_convert_examples_to_features(
+    labeled_examples, unlabeled_examples, label_list, max_seq_length, tokenizer, output_file, label_mask_rate, is_testing=False,
+    num_shards=1, reuse_features=False, record_format="padded",
+    oversampling_mode="duplicate", labeled_sampling_weight=None):
+  """Convert a set of `InputExample`s to a TFRecord file.
+
+  The examples are lists of `InputExample`s and `PaddingInputExample`s, or
+  `ExampleTable`s. Records are converted and written in chunks following `get_write_order`,
+  so memory use does not grow with the number of examples. With
+  `num_shards` > 1 the examples are split across as many worker
+  processes, each writing its own shard next to `output_file` (see
+  `get_shard_file`). Either way a manifest listing the written files and
+  their record counts is stored by `write_record_manifest`; use
+  `read_record_files` to get the files back.
+
+  With `reuse_features`, nothing is converted if the manifest of
+  `output_file` was written for the same `get_features_fingerprint`.
+  `record_format` is "padded" or "compact", see `create_tf_examples` and
+  `create_compact_tf_examples`, or "npy" to write `feature_store` directories
+  instead of TFRecord files.
+
+  With `oversampling_mode` "sample", labeled and unlabeled examples are
+  written once each, to separate files, and the manifest stores the weight
+  of the labeled ones for `file_based_input_fn_builder` to sample them with:
+  `labeled_sampling_weight` if given, else `get_labeled_sampling_weight`.
+  """
+  all_examples = labeled_examples
+  if unlabeled_examples:
+    all_examples = all_examples + unlabeled_examples
+  label_masks = get_labeled_mask(mask_size=len(all_examples), labeled_size=len(labeled_examples))
+  label_map = create_label_map(label_list)
+
+  num_labeled = len(labeled_examples)
+  labeled_weight = None
+  if (oversampling_mode == "sample" and label_mask_rate != 1 and num_labeled
+      and len(all_examples) > num_labeled):
+    labeled_weight = labeled_sampling_weight or get_labeled_sampling_weight(
+        num_labeled, len(all_examples) - num_labeled, label_mask_rate)
+
+  fingerprint = get_features_fingerprint(
+      all_examples, label_masks, label_list, max_seq_length, tokenizer,
+      label_mask_rate, is_testing, num_shards, record_format, labeled_weight)
+  if reuse_features:
+    num_examples = read_cached_num_examples(output_file, fingerprint)
+    if num_examples is not None:
+      tf.logging.info("Reusing the %d features of %s", num_examples,
+                      output_file)
+      return num_examples
+
+  # A generator of its own keeps the order, and so the fingerprint, the same
+  # whatever the global `random` state, e.g. in eval-only runs.
+  rng = random.Random(SEED)
+  record_file = output_file
+  if record_format == "npy":
+    record_file = os.path.splitext(output_file)[0] + feature_store.STORE_EXTENSION
+  if labeled_weight is None:
+    streams = [(record_file,
+                get_write_order(label_masks, label_mask_rate, is_testing, rng))]
+  else:
+    unlabeled_order = get_write_order(label_masks[num_labeled:], 1, is_testing,
+                                      rng)
+    streams = [
+        (get_stream_file(record_file, "labeled"),
+         get_write_order(label_masks[:num_labeled], 1, is_testing, rng)),
+        (get_stream_file(record_file, "unlabeled"),
+         [num_labeled + i for i in unlabeled_order])]
+
+  stream_files = []
+  record_counts = []
+  length_counts = np.zeros([max_seq_length + 1], dtype=np.int64)
+  for stream_file, write_order in streams:
+    if num_shards > 1:
+      record_files = [get_shard_file(stream_file, shard, num_shards)
+                      for shard in range(num_shards)]
+      for count, file_length_counts in write_record_shards(
+          all_examples, write_order, label_map, max_seq_length, tokenizer,
+          label_masks, record_format, record_files):
+        record_counts.append(count)
+        length_counts += file_length_counts
     else:
-        # IT SIMULATE A LABELED EXAMPLE
-        if feature.label_mask:
-            balance = int(1/label_mask_rate)
-            balance = int(math.log(balance,2))
-            if balance < 1:
-                balance = 1
-            for b in range(0, int(balance)):
-                to_write_examples.append(tf_example)
-        else:
-          to_write_examples.append(tf_example)
-
-  writer = tf.python_io.TFRecordWriter(output_file)
-  written_examples = 0
+      record_files = [stream_file]
+      count, file_length_counts = write_record_file(
+          stream_file, write_order, all_examples, label_map, max_seq_length,
+          tokenizer, label_masks, record_format,
+          num_workers=FLAGS.tokenize_num_workers)
+      record_counts.append(count)
+      length_counts += file_length_counts
+    stream_files.append(record_files)
+  tokenizer.close_pool()
+  if tokenizer.ids_cache is not None:
+    tokenizer.ids_cache.save()
+
+  record_files = [f for files in stream_files for f in files]
+  labeled_files = stream_files[0] if labeled_weight is not None else None
+  write_record_manifest(output_file, record_files, record_counts, fingerprint,
+                        record_format, len(label_list),
+                        get_token_dtype(tokenizer), labeled_files,
+                        labeled_weight, length_counts)
+  return sum(record_counts)
+
+
+def get_stream_file(output_file, stream):
+  """Returns e.g. train-labeled.tf_record for train.tf_record."""
+  root, extension = os.path.splitext(output_file)
+  return "%s-%s%s" % (root, stream, extension)
+
+
+def get_labeled_repeats(label_mask_rate):
+  """Number of times a labeled example is written to simulate oversampling."""
+  if label_mask_rate == 1:
+    return 1
+  balance = int(1/label_mask_rate)
+  balance = int(math.log(balance,2))
+  if balance < 1:
+      balance = 1
+  return balance
+
+
+def get_labeled_sampling_weight(num_labeled, num_unlabeled, label_mask_rate):
+  """Share of labeled records in the file written by the `duplicate` mode."""
+  num_labeled *= get_labeled_repeats(label_mask_rate)
+  return num_labeled / float(num_labeled + num_unlabeled)
+
+
+def get_write_order(label_masks, label_mask_rate, is_testing, rng):
+  """Returns the example indices in the order their records are written.
+
+  Labeled examples appear `get_labeled_repeats` times. Unless testing, the
+  order is shuffled with the `random.Random` `rng`; shuffling the indices
+  instead of the records keeps only one int per record in memory.
+  """
+  labeled_repeats = get_labeled_repeats(label_mask_rate)
+  write_order = []
+  for ex_index, label_mask in enumerate(label_masks):
+    write_order.extend([ex_index] * (labeled_repeats if label_mask else 1))
   if not is_testing:
-    random.shuffle(to_write_examples)
-  for tf_example in to_write_examples:
-    writer.write(tf_example.SerializeToString())
-    written_examples = written_examples + 1
+    rng.shuffle(write_order)
+  return write_order
+
+
+def get_shard_file(output_file, shard, num_shards):
+  """Returns e.g. train-00003-of-00032.tf_record for train.tf_record."""
+  root, extension = os.path.splitext(output_file)
+  return "%s-%05d-of-%05d%s" % (root, shard, num_shards, extension)
+
+
+# State shared with the processes forked by `write_record_shards`.
+_shard_writer_args = None
+
+
+def write_record_shards(all_examples, write_order, label_map, max_seq_length,
+                        tokenizer, label_masks, record_format, record_files):
+  """Writes `write_order` to the TFRecord `record_files` in parallel.
+
+  The order is cut into contiguous slices, so reading the shards one after the
+  other yields the records in `write_order`. Returns what `write_record_file`
+  returns for each shard. The texts the workers tokenize are added to
+  `tokenizer.ids_cache`.
+  """
+  global _shard_writer_args
+  _shard_writer_args = (all_examples, label_map, max_seq_length, tokenizer,
+                        label_masks, record_format)
+  num_shards = len(record_files)
+  shard_size = int(math.ceil(len(write_order) / float(num_shards)))
+  jobs = [(record_file, write_order[shard * shard_size:(shard + 1) * shard_size])
+          for shard, record_file in enumerate(record_files)]
+
+  # Set aside, so that every shard only reports the texts it tokenized.
+  ids_cache = tokenizer.ids_cache
+  if ids_cache is not None:
+    pending_entries = ids_cache.take_new_entries()
+  try:
+    if "fork" not in multiprocessing.get_all_start_methods():
+      # The workers read the examples from the state inherited when forking.
+      results = [_write_record_shard(job) for job in jobs]
+    else:
+      pool = multiprocessing.get_context("fork").Pool(processes=num_shards)
+      try:
+        results = pool.map(_write_record_shard, jobs, chunksize=1)
+      finally:
+        pool.terminate()
+        pool.join()
+  finally:
+    _shard_writer_args = None
+    if ids_cache is not None:
+      ids_cache.add_entries(pending_entries)
+
+  if ids_cache is not None:
+    for _, _, new_entries in results:
+      ids_cache.add_entries(new_entries)
+  return [(count, length_counts) for count, length_counts, _ in results]
+
+
+def _write_record_shard(job):
+  """Converts and writes the examples of one shard. Runs in a worker.
+
+  Returns what `write_record_file` returns and the entries the shard added to
+  the tokenizer's `ids_cache`, which are lost with the worker otherwise.
+  """
+  shard_file, shard_order = job
+  count, length_counts = write_record_file(shard_file, shard_order,
+                                           *_shard_writer_args)
+  ids_cache = _shard_writer_args[3].ids_cache
+  new_entries = ids_cache.take_new_entries() if ids_cache is not None else {}
+  return count, length_counts, new_entries
+
+
+def write_record_file(record_file, write_order, all_examples, label_map,
+                      max_seq_length, tokenizer, label_masks,
+                      record_format="padded", num_workers=1):
+  """Writes the examples at the indices `write_order` to `record_file`.
+
+  Only `CONVERT_CHUNK_SIZE` records are held in memory at a time. Examples
+  repeated within a chunk are converted once. Returns the number of records
+  and the number of records of each sequence length, from 0 to
+  `max_seq_length`.
+  """
+  length_counts = np.zeros([max_seq_length + 1], dtype=np.int64)
+  if record_format == "npy":
+    writer = feature_store.FeatureStoreWriter(
+        record_file, len(write_order), get_token_dtype(tokenizer),
+        dtypes=NPY_FEATURE_DTYPES)
+  else:
+    writer = tf.python_io.TFRecordWriter(record_file)
+  for start in range(0, len(write_order), CONVERT_CHUNK_SIZE):
+    tf.logging.info("Writing example %d of %d" % (start, len(write_order)))
+    chunk, record_index = np.unique(
+        write_order[start:start + CONVERT_CHUNK_SIZE], return_inverse=True)
+    arrays = convert_examples_to_feature_arrays(
+        take_examples(all_examples, chunk), label_map, max_seq_length,
+        tokenizer, label_masks[chunk], num_workers=num_workers)
+    arrays = collections.OrderedDict(
+        (name, array[record_index]) for name, array in arrays.items())
+    length_counts += np.bincount(arrays["input_mask"].sum(axis=1),
+                                 minlength=max_seq_length + 1)
+    if record_format == "npy":
+      writer.write(arrays)
+      continue
+    if record_format == "compact":
+      tf_examples = create_compact_tf_examples(arrays,
+                                               get_token_dtype(tokenizer))
+    else:
+      tf_examples = create_tf_examples(arrays)
+    for tf_example in tf_examples:
+      writer.write(tf_example.SerializeToString())
   writer.close()
+  tf.logging.info("Wrote %d examples to %s", len(write_order), record_file)
+  return len(write_order), length_counts
+
+
+def get_features_fingerprint(all_examples, label_masks, label_list,
+                             max_seq_length, tokenizer, label_mask_rate,
+                             is_testing, num_shards, record_format,
+                             labeled_weight=None):
+  """Returns a hash of everything the written feature records depend on.
+
+  That is the examples, which of them are labeled, the label list, the
+  vocabulary and casing of `tokenizer`, `max_seq_length`, the oversampling
+  factor or sampling weight, the shuffling (including its seed), the sharding
+  and the record format. An `ExampleTable` is hashed by its columns and a
+  list of examples `CONVERT_CHUNK_SIZE` at a time, so the cost is close to
+  that of reading the texts once.
+  """
+  hasher = hashlib.sha1()
+
+  def update(value):
+    hasher.update(tokenization.convert_to_unicode(
+        json.dumps(value)).encode("utf-8"))
+    hasher.update(b"\x00")
+
+  update([FEATURES_FORMAT_VERSION, record_format, labeled_weight])
+  update([max_seq_length, tokenizer.basic_tokenizer.do_lower_case,
+          get_labeled_repeats(label_mask_rate), bool(is_testing), num_shards])
+  update(list(label_list))
+  hasher.update(u"\n".join(tokenizer.inv_vocab).encode("utf-8"))
+  hasher.update(b"\x00")
+  update(SEED if not is_testing else None)
+  hasher.update(np.asarray(label_masks, dtype=np.int8).tobytes())
+  if isinstance(all_examples, ExampleTable):
+    all_examples.update_hash(hasher)
+  else:
+    for start in range(0, len(all_examples), CONVERT_CHUNK_SIZE):
+      update([None if isinstance(example, PaddingInputExample) else
+              [example.guid, example.text_a, example.text_b, example.label]
+              for example in all_examples[start:start + CONVERT_CHUNK_SIZE]])
+  return hasher.hexdigest()
+
+
+def get_manifest_file(output_file):
+  return output_file + ".manifest.json"
+
+
+def write_record_manifest(output_file, record_files, record_counts,
+                          fingerprint=None, record_format="padded",
+                          num_labels=None, token_dtype=None,
+                          labeled_files=None, labeled_weight=None,
+                          length_counts=None):
+  """Stores which files hold the records of `output_file`, and how many.
+
+  The record format, number of labels, token dtype and, when labeled
+  examples are sampled, which files hold them and with what weight are
+  stored as well, for `file_based_input_fn_builder`, along with the number
+  of records of each sequence length, for `get_num_batches`.
+  """
+  manifest = collections.OrderedDict()
+  manifest["files"] = [os.path.basename(f) for f in record_files]
+  manifest["counts"] = [int(c) for c in record_counts]
+  manifest["num_examples"] = int(sum(record_counts))
+  manifest["fingerprint"] = fingerprint
+  manifest["record_format"] = record_format
+  manifest["num_labels"] = num_labels
+  manifest["token_dtype"] = token_dtype
+  manifest["labeled_files"] = [os.path.basename(f) for f in labeled_files or []]
+  manifest["labeled_weight"] = labeled_weight
+  if length_counts is not None:
+    length_counts = [int(c) for c in length_counts]
+  manifest["length_counts"] = length_counts
+  with tf.gfile.GFile(get_manifest_file(output_file), "w") as writer:
+    json.dump(manifest, writer, indent=2)
+
+
+def read_cached_num_examples(output_file, fingerprint):
+  """Returns the number of records of `output_file` if they can be reused.
+
+  That is when its manifest has the given fingerprint and all of its record
+  files exist. Returns None otherwise.
+  """
+  manifest_file = get_manifest_file(output_file)
+  if not tf.gfile.Exists(manifest_file):
+    return None
+  with tf.gfile.GFile(manifest_file, "r") as reader:
+    manifest = json.load(reader)
+  if manifest.get("fingerprint") != fingerprint:
+    return None
+  output_dir = os.path.dirname(output_file)
+  for record_file in manifest["files"]:
+    if not tf.gfile.Exists(os.path.join(output_dir, record_file)):
+      return None
+  return manifest["num_examples"]
+
+
+def read_record_manifest(output_file):
+  """Returns the manifest of `output_file`, with the full record file paths."""
+  with tf.gfile.GFile(get_manifest_file(output_file), "r") as reader:
+    manifest = json.load(reader)
+  output_dir = os.path.dirname(output_file)
+  for key in ["files", "labeled_files"]:
+    manifest[key] = [os.path.join(output_dir, f) for f in manifest[key]]
+  return manifest
+
+
+def read_record_files(output_file):
+  """Returns the TFRecord files written for `output_file`, in order."""
+  return read_record_manifest(output_file)["files"]
+
+
+def manifest_input_fn_builder(output_file, seq_length, is_training,
+                              drop_remainder, keep_order=False):
+  """`file_based_input_fn_builder` for the records written for `output_file`.
+
+  Buckets by length and limits the tokens per batch as set by
+  --bucket_boundaries and --max_tokens_per_batch, except on TPU. Feature
+  stores written with --record_format=npy are read with
+  `feature_store.input_fn_builder`.
+  """
+  manifest = read_record_manifest(output_file)
+  unlabeled_files = [f for f in manifest["files"]
+                     if f not in manifest["labeled_files"]]
+  if manifest["record_format"] == "npy":
+    if is_training:
+      return feature_store.input_fn_builder(
+          store_dirs=unlabeled_files,
+          is_training=True,
+          drop_remainder=drop_remainder,
+          batch_size=FLAGS.train_batch_size,
+          labeled_store_dirs=manifest["labeled_files"],
+          labeled_weight=manifest["labeled_weight"],
+          seed=SEED)
+    return feature_store.input_fn_builder(
+        store_dirs=manifest["files"],
+        is_training=False,
+        drop_remainder=drop_remainder)
 
-  return written_examples
-
-
-def file_based_input_fn_builder(input_file, seq_length, is_training, drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
-
-  name_to_features = {
-      "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "input_mask": tf.FixedLenFeature([seq_length], tf.int64),
-      "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "label_ids": tf.FixedLenFeature([33], tf.int64),
-      "is_real_example": tf.FixedLenFeature([], tf.int64),
-      "label_mask": tf.FixedLenFeature([], tf.int64),
-  }
+  bucket_boundaries, max_tokens_per_batch = get_dynamic_batching(seq_length)
+  return file_based_input_fn_builder(
+      input_file=unlabeled_files,
+      seq_length=seq_length,
+      is_training=is_training,
+      drop_remainder=drop_remainder,
+      num_labels=manifest["num_labels"],
+      record_format=manifest["record_format"],
+      token_dtype=manifest["token_dtype"],
+      bucket_boundaries=bucket_boundaries,
+      keep_order=keep_order,
+      max_tokens_per_batch=max_tokens_per_batch,
+      labeled_input_file=manifest["labeled_files"],
+      labeled_weight=manifest["labeled_weight"])
+
+
+def get_dynamic_batching(seq_length):
+  """Returns the bucket boundaries and token budget set by the flags.
+
+  Both are None unless set, and always on TPU. --max_tokens_per_batch
+  without --bucket_boundaries buckets by `get_default_bucket_boundaries`.
+  """
+  bucket_boundaries = None
+  max_tokens_per_batch = None
+  if not FLAGS.use_tpu:
+    bucket_boundaries = [int(b) for b in FLAGS.bucket_boundaries]
+    if FLAGS.max_tokens_per_batch > 0:
+      max_tokens_per_batch = FLAGS.max_tokens_per_batch
+      if not bucket_boundaries:
+        bucket_boundaries = get_default_bucket_boundaries(seq_length)
+  return bucket_boundaries, max_tokens_per_batch
+
+
+def get_bucket_batch_sizes(bucket_boundaries, seq_length, batch_size,
+                           max_tokens_per_batch=None):
+  """Returns the boundaries and batch sizes of `bucket_by_sequence_length`.
+
+  A sequence of length `n` goes to the first bucket whose boundary is greater
+  than `n`, and is padded to that boundary minus one. Every bucket batches
+  `batch_size` sequences, or as many as fit in `max_tokens_per_batch` padded
+  tokens.
+  """
+  boundaries = sorted(set(b for b in bucket_boundaries if b <= seq_length))
+  boundaries.append(seq_length + 1)
+  if max_tokens_per_batch:
+    bucket_batch_sizes = [max(1, max_tokens_per_batch // max(1, b - 1))
+                          for b in boundaries]
+    # Sequences are never longer than `seq_length`: the last bucket is empty.
+    bucket_batch_sizes.append(1)
+  else:
+    bucket_batch_sizes = [batch_size] * (len(boundaries) + 1)
+  return boundaries, bucket_batch_sizes
+
+
+def get_num_batches(length_counts, bucket_boundaries, seq_length,
+                    max_tokens_per_batch):
+  """Returns the number of token budget batches of one pass over records.
+
+  `length_counts` holds the number of records of each sequence length, as
+  stored in the manifest. The count is fractional: the partial batch left in
+  each bucket is counted by the share of it that is filled.
+  """
+  boundaries, bucket_batch_sizes = get_bucket_batch_sizes(
+      bucket_boundaries, seq_length, None, max_tokens_per_batch)
+  num_batches = 0.0
+  for length, count in enumerate(length_counts):
+    bucket = bisect.bisect_right(boundaries, length)
+    num_batches += count / float(bucket_batch_sizes[bucket])
+  return num_batches
+
+
+def get_default_bucket_boundaries(seq_length):
+  """Powers of two from 8 up to `seq_length`."""
+  boundaries = []
+  boundary = 8
+  while boundary <= seq_length:
+    boundaries.append(boundary)
+    boundary *= 2
+  return boundaries
+
+
+def file_based_input_fn_builder(input_file, seq_length, is_training, drop_remainder,
+                                num_labels, record_format="padded", token_dtype=None,
+                                bucket_boundaries=None, keep_order=False,
+                                max_tokens_per_batch=None, labeled_input_file=None,
+                                labeled_weight=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  With `bucket_boundaries`, sequences are padded per batch rather than to
+  `seq_length`: records are grouped into batches of similar length with
+  `bucket_by_sequence_length`, or, with `keep_order`, batched in file order
+  and padded to the longest sequence of the batch. With
+  `max_tokens_per_batch` as well, each bucket batches as many records as fit
+  in that many padded tokens; `keep_order` batches keep the batch size.
+
+  With `labeled_input_file`, training examples are drawn from its records
+  with probability `labeled_weight` and from `input_file` otherwise.
+  """
+  dynamic_padding = bool(bucket_boundaries)
+
+  if record_format == "compact":
+    name_to_features = {
+        "token_ids": tf.FixedLenFeature([], tf.string),
+        "length_a": tf.FixedLenFeature([], tf.int64),
+        "label_ids": tf.VarLenFeature(tf.int64),
+        "is_real_example": tf.FixedLenFeature([], tf.int64),
+        "label_mask": tf.FixedLenFeature([], tf.int64),
+    }
+  else:
+    name_to_features = {
+        "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "input_mask": tf.FixedLenFeature([seq_length], tf.int64),
+        "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
+        "label_ids": tf.FixedLenFeature([num_labels], tf.int64),
+        "is_real_example": tf.FixedLenFeature([], tf.int64),
+        "label_mask": tf.FixedLenFeature([], tf.int64),
+    }
+
+  def _expand_compact_record(example):
+    """Rebuilds the padded features from a compact record."""
+    token_ids = tf.decode_raw(example.pop("token_ids"), tf.as_dtype(token_dtype),
+                              little_endian=True)
+    length = tf.shape(token_ids)[0]
+    if dynamic_padding:
+      # Padding is added when batching.
+      input_ids = tf.cast(token_ids, tf.int64)
+      positions = tf.range(length)
+    else:
+      input_ids = tf.pad(tf.cast(token_ids, tf.int64), [[0, seq_length - length]])
+      input_ids.set_shape([seq_length])
+      positions = tf.range(seq_length)
+    example["input_ids"] = input_ids
+    example["input_mask"] = tf.cast(positions < length, tf.int64)
+    example["segment_ids"] = tf.cast(
+        tf.logical_and(positions >= tf.cast(example.pop("length_a"), tf.int32),
+                       positions < length), tf.int64)
+    label_ids = tf.reduce_sum(
+        tf.one_hot(example["label_ids"].values, num_labels, dtype=tf.int64),
+        axis=0)
+    example["label_ids"] = tf.minimum(label_ids, 1)
+    return example
 
-  def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
-    example = tf.parse_single_example(record, name_to_features)
+  def _expand_compact_batch(example, batch_size):
+    """Rebuilds the padded features from a batch of compact records."""
+    token_bytes = example.pop("token_ids")
+    # All the token ids of the batch, decoded at once and scattered into rows.
+    flat_ids = tf.decode_raw(tf.strings.reduce_join(token_bytes, axis=0),
+                             tf.as_dtype(token_dtype), little_endian=True)
+    lengths = tf.strings.length(token_bytes) // tf.as_dtype(token_dtype).size
+    row_splits = tf.concat([[0], tf.cumsum(lengths)], axis=0)
+    row_ids = tf.ragged.row_splits_to_segment_ids(row_splits)
+    columns = tf.range(tf.size(flat_ids)) - tf.gather(row_splits, row_ids)
+    input_ids = tf.scatter_nd(tf.stack([row_ids, columns], axis=1),
+                              tf.cast(flat_ids, tf.int64),
+                              tf.stack([tf.size(lengths), seq_length]))
+    input_ids.set_shape([batch_size, seq_length])
+
+    positions = tf.range(seq_length)[tf.newaxis, :]
+    input_mask = positions < lengths[:, tf.newaxis]
+    length_a = tf.cast(example.pop("length_a"), tf.int32)
+    example["input_ids"] = input_ids
+    example["input_mask"] = tf.cast(input_mask, tf.int64)
+    example["segment_ids"] = tf.cast(
+        tf.logical_and(positions >= length_a[:, tf.newaxis], input_mask),
+        tf.int64)
+    label_ids = tf.sparse_to_indicator(example["label_ids"], num_labels)
+    label_ids.set_shape([batch_size, num_labels])
+    example["label_ids"] = tf.cast(label_ids, tf.int64)
+    return example
 
+  def _cast_features(example):
     # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
     # So cast all int64 to int32.
     for name in list(example.keys()):
@@ -328,48 +972,102 @@ def file_based_input_fn_builder(input_file, seq_length, is_training, drop_remain
 
     return example
 
+  def _decode_record(record, name_to_features):
+    """Decodes a record to a TensorFlow example."""
+    example = tf.parse_single_example(record, name_to_features)
+    if record_format == "compact":
+      example = _expand_compact_record(example)
+    elif dynamic_padding:
+      length = tf.reduce_sum(example["input_mask"])
+      for name in ["input_ids", "input_mask", "segment_ids"]:
+        example[name] = example[name][:length]
+    return _cast_features(example)
+
+  def _decode_batch(records, batch_size):
+    """Decodes a batch of records with a single `parse_example`."""
+    example = tf.parse_example(records, name_to_features)
+    if record_format == "compact":
+      example = _expand_compact_batch(example, batch_size)
+    return _cast_features(example)
+
+  def _read_records(files):
+    """Reads the records of `files`, interleaving them when training."""
+    if not is_training or len(files) == 1:
+      # Eval and predict read the files one after the other, in order.
+      return tf.data.TFRecordDataset(files)
+    d = tf.data.Dataset.from_tensor_slices(tf.constant(files))
+    d = d.repeat()
+    d = d.shuffle(buffer_size=len(files), seed=SEED)
+    # `sloppy` lets the interleave return records of whichever file is ready.
+    return d.apply(
+        tf.contrib.data.parallel_interleave(
+            tf.data.TFRecordDataset,
+            sloppy=True,
+            cycle_length=min(FLAGS.input_num_parallel_reads, len(files))))
+
   def input_fn(params):
     """The actual input function."""
     if is_training:
         batch_size = FLAGS.train_batch_size
     else:
         batch_size = params["batch_size"]
+    num_parallel_calls = FLAGS.input_num_parallel_calls
+    if num_parallel_calls < 0:
+      num_parallel_calls = tf.data.experimental.AUTOTUNE
 
     # For training, we want a lot of parallel reading and shuffling.
     # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
+    if labeled_input_file and not is_training:
+      d = _read_records(labeled_input_file + input_file)
+    else:
+      d = _read_records(input_file)
     if is_training:
       d = d.repeat()
       d = d.shuffle(buffer_size=10000, seed=SEED)
+      if labeled_input_file:
+        labeled = _read_records(labeled_input_file).repeat()
+        labeled = labeled.shuffle(buffer_size=10000, seed=SEED)
+        d = tf.data.experimental.sample_from_datasets(
+            [labeled, d], weights=[labeled_weight, 1 - labeled_weight],
+            seed=SEED)
+
+    if not dynamic_padding:
+      # Batching the serialized records first parses a whole batch per call.
+      d = d.batch(batch_size, drop_remainder=drop_remainder)
+      d = d.map(
+          lambda records: _decode_batch(
+              records, batch_size if drop_remainder else None),
+          num_parallel_calls=num_parallel_calls)
+    else:
+      d = d.map(lambda record: _decode_record(record, name_to_features),
+                num_parallel_calls=num_parallel_calls)
+      d = _batch_dynamically(d, batch_size)
+
+    if FLAGS.input_prefetch_batches < 0:
+      d = d.prefetch(tf.data.experimental.AUTOTUNE)
+    elif FLAGS.input_prefetch_batches > 0:
+      d = d.prefetch(FLAGS.input_prefetch_batches)
+    return d
 
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
+  def _batch_dynamically(d, batch_size):
+    """Batches decoded records padded per batch, see above."""
+    if keep_order:
+      return d.padded_batch(batch_size, padded_shapes=d.output_shapes,
+                            drop_remainder=drop_remainder)
+
+    boundaries, bucket_batch_sizes = get_bucket_batch_sizes(
+        bucket_boundaries, seq_length, batch_size, max_tokens_per_batch)
+    return d.apply(
+        tf.data.experimental.bucket_by_sequence_length(
+            element_length_func=lambda example: tf.shape(example["input_ids"])[0],
+            bucket_boundaries=boundaries,
+            bucket_batch_sizes=bucket_batch_sizes,
+            pad_to_bucket_boundary=True,
             drop_remainder=drop_remainder))
 
-    return d
-
   return input_fn
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-  """Truncates a sequence pair in place to the maximum length."""
-
-  # This is a simple heuristic which will always truncate the longer sequence
-  # one token at a time. This makes more sense than truncating an equal percent
-  # of tokens from each, since if one sequence is very short then each token
-  # that's truncated likely contains more information than a longer sequence.
-  while True:
-    total_length = len(tokens_a) + len(tokens_b)
-    if total_length <= max_length:
-      break
-    if len(tokens_a) > len(tokens_b):
-      tokens_a.pop()
-    else:
-      tokens_b.pop()
-
-
 ############ Defining Discriminator ############
 def discriminator(x, d_hidden_size, dkp, is_training, num_labels, num_hidden_discriminator = 1, reuse = False):
     with tf.compat.v1.variable_scope('Discriminator', reuse = reuse):
@@ -441,7 +1139,9 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
     per_example_loss = -tf.reduce_sum(labels * log_probs, axis=-1)
     D_L_Supervised = tf.reduce_mean(per_example_loss)
 
-  z = tf.random_uniform([FLAGS.train_batch_size, LATENT_Z], minval=0, maxval=1, dtype=tf.float32, seed=SEED, name=None)
+  # As many fake examples as real ones, also when batches vary in size.
+  real_batch_size = modeling.get_shape_list(input_ids)[0]
+  z = tf.random_uniform([real_batch_size, LATENT_Z], minval=0, maxval=1, dtype=tf.float32, seed=SEED, name=None)
   x_g = generator(z, hidden_size, keep_prob, is_training=is_training, reuse=False)
   D_fake_features, DU_fake_logits, DU_fake_prob = discriminator(x_g, hidden_size, keep_prob, is_training, num_labels, reuse=True)
   
@@ -593,12 +1293,14 @@ def evaluate(estimator, label_rate, eval_examples, task_name, label_list, tokeni
         # will get dropped. So we pad with fake examples which are ignored
         # later on. These do NOT count towards the metric (all tf.metrics
         # support a per-instance weight, and these get a weight of 0.0).
-        while len(eval_examples) % FLAGS.eval_batch_size != 0:
-            eval_examples.append(PaddingInputExample())
+        eval_examples.extend([PaddingInputExample()] *
+                             (-len(eval_examples) % FLAGS.eval_batch_size))
 
     eval_file = os.path.join(FLAGS.output_dir, "eval_"+str(task_name)+".tf_record")
     file_based_convert_examples_to_features(
-        eval_examples, None, label_list, FLAGS.max_seq_length, tokenizer, eval_file, label_mask_rate=1)
+        eval_examples, None, label_list, FLAGS.max_seq_length, tokenizer, eval_file, label_mask_rate=1,
+        num_shards=FLAGS.num_record_shards,
+        reuse_features=FLAGS.reuse_features, record_format=FLAGS.record_format)
 
 
     tf.logging.info("***** Running evaluation *****")
@@ -616,8 +1318,8 @@ def evaluate(estimator, label_rate, eval_examples, task_name, label_list, tokeni
         eval_steps = int(len(eval_examples) // FLAGS.eval_batch_size)
 
     eval_drop_remainder = True if FLAGS.use_tpu else False
-    eval_input_fn = file_based_input_fn_builder(
-        input_file=eval_file,
+    eval_input_fn = manifest_input_fn_builder(
+        output_file=eval_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
         drop_remainder=eval_drop_remainder)
@@ -644,7 +1346,6 @@ def main(_):
 
   label_rate = FLAGS.label_rate
 
-  processors = {"qc-fine": QcFineProcessor}
 
   tokenization.validate_case_matches_checkpoint(FLAGS.do_lower_case,
                                                 FLAGS.init_checkpoint)
@@ -665,18 +1366,29 @@ def main(_):
 
   task_name = FLAGS.task_name.lower()
 
-  if task_name not in processors:
-    raise ValueError("Task not found: %s" % (task_name))
+  deduplicator = None
+  if FLAGS.dedup_mode != "none":
+    deduplicator = Deduplicator(
+        near_duplicates=FLAGS.dedup_mode == "near",
+        threshold=FLAGS.near_duplicate_threshold, seed=SEED)
 
-  processor = processors[task_name]()
-  processor._create_examples(input_file='../../datasets/multiLabel_text_classification/ProgrammerWeb/programweb-data.csv')
+  processor = get_processor(
+      task_name, unlabeled_multiplier=FLAGS.unlabeled_multiplier, seed=SEED,
+      deduplicator=deduplicator)
+  processor.load_examples(FLAGS.data_dir, input_file=FLAGS.input_file)
+  if deduplicator is not None:
+    print(deduplicator.summary())
 
   label_list = processor.get_labels()
   print(label_list)
   print(len(label_list))
 
   tokenizer = tokenization.FullTokenizer(
-      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+      vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case,
+      cache_size=FLAGS.tokenizer_cache_size)
+  if FLAGS.tokenization_cache_dir:
+    tokenizer.ids_cache = tokenization_cache.TokenizationCache(
+        FLAGS.tokenization_cache_dir, FLAGS.vocab_file, FLAGS.do_lower_case)
 
   tpu_cluster_resolver = None
   if FLAGS.use_tpu and FLAGS.tpu_name:
@@ -704,9 +1416,30 @@ def main(_):
     num_train_examples = len(labeled_examples) + len(unlabeled_examples)
     print(num_train_examples)
 
+    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
+    num_written_examples = file_based_convert_examples_to_features(
+        labeled_examples, unlabeled_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file,
+        label_mask_rate=label_rate, num_shards=FLAGS.num_record_shards,
+        reuse_features=FLAGS.reuse_features, record_format=FLAGS.record_format,
+        oversampling_mode=FLAGS.oversampling_mode,
+        labeled_sampling_weight=FLAGS.labeled_sampling_weight)
+
+    # Under a token budget batches hold a varying number of examples, so the
+    # steps follow from the batches the written records fill.
+    examples_per_batch = FLAGS.train_batch_size
+    bucket_boundaries, max_tokens_per_batch = get_dynamic_batching(
+        FLAGS.max_seq_length)
+    if max_tokens_per_batch and FLAGS.record_format != "npy":
+      num_batches = get_num_batches(
+          read_record_manifest(train_file)["length_counts"], bucket_boundaries,
+          FLAGS.max_seq_length, max_tokens_per_batch)
+      examples_per_batch = num_written_examples / max(num_batches, 1.0)
+
     num_train_steps = int(
-         num_train_examples / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+         num_train_examples / examples_per_batch * FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
+    real_num_train_steps = int(
+         num_written_examples / examples_per_batch * FLAGS.num_train_epochs)
 
   model_fn = model_fn_builder(
       bert_config=bert_config,
@@ -729,20 +1462,15 @@ def main(_):
       predict_batch_size=FLAGS.predict_batch_size)
 
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
-    num_written_examples = file_based_convert_examples_to_features(
-        labeled_examples, unlabeled_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file,
-        label_mask_rate=label_rate)
-
-    real_num_train_steps = int(
-         num_written_examples / FLAGS.train_batch_size * FLAGS.num_train_epochs)
-
     tf.logging.info("***** Running training *****")
     tf.logging.info("  Num examples = %d", len(labeled_examples) + len(unlabeled_examples))
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
+    if examples_per_batch != FLAGS.train_batch_size:
+      tf.logging.info("  Tokens per batch = %d (%.1f examples on average)",
+                      FLAGS.max_tokens_per_batch, examples_per_batch)
     tf.logging.info("  Num steps = %d", real_num_train_steps)
-    train_input_fn = file_based_input_fn_builder(
-        input_file=train_file,
+    train_input_fn = manifest_input_fn_builder(
+        output_file=train_file,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
         drop_remainder=True)
@@ -763,13 +1491,16 @@ def main(_):
       # of examples must be a multiple of the batch size, or else examples
       # will get dropped. So we pad with fake examples which are ignored
       # later on.
-      while len(predict_examples) % FLAGS.predict_batch_size != 0:
-        predict_examples.append(PaddingInputExample())
+      predict_examples.extend([PaddingInputExample()] *
+                              (-len(predict_examples) % FLAGS.predict_batch_size))
 
     predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
     file_based_convert_examples_to_features(predict_examples, None, label_list,
                                             FLAGS.max_seq_length, tokenizer,
-                                            predict_file, label_mask_rate=label_rate, is_testing=True)
+                                            predict_file, label_mask_rate=label_rate, is_testing=True,
+                                            num_shards=FLAGS.num_record_shards,
+                                            reuse_features=FLAGS.reuse_features,
+                                            record_format=FLAGS.record_format)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -778,11 +1509,13 @@ def main(_):
     tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
 
     predict_drop_remainder = True if FLAGS.use_tpu else False
-    predict_input_fn = file_based_input_fn_builder(
-        input_file=predict_file,
+    predict_input_fn = manifest_input_fn_builder(
+        output_file=predict_file,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
-        drop_remainder=predict_drop_remainder)
+        drop_remainder=predict_drop_remainder,
+        # The predictions are written in the order of the examples.
+        keep_order=True)
 
     result = estimator.predict(input_fn=predict_input_fn)
 
@@ -5,8 +5,12 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import itertools
+import multiprocessing
+import os
 import re
 import unicodedata
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -107,18 +111,22 @@ def printable_text(text):
 def load_vocab(vocab_file):
   """Loads a vocabulary file into a dictionary."""
   vocab = collections.OrderedDict()
-  index = 0
-  with tf.gfile.GFile(vocab_file, "r") as reader:
-    while True:
-      token = convert_to_unicode(reader.readline())
-      if not token:
-        break
-      token = token.strip()
-      vocab[token] = index
-      index += 1
+  for index, token in enumerate(load_vocab_tokens(vocab_file)):
+    vocab[token] = index
   return vocab
 
 
+def load_vocab_tokens(vocab_file):
+  """Loads a vocabulary file into a list of tokens indexed by id."""
+  with tf.gfile.GFile(vocab_file, "rb") as reader:
+    data = reader.read()
+
+  lines = convert_to_unicode(data).split("\n")
+  if not lines[-1]:
+    lines.pop()
+  return [line.strip() for line in lines]
+
+
 def convert_by_vocab(vocab, items):
   """Converts a sequence of [tokens|ids] using the vocab."""
   output = []
@@ -147,20 +155,306 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
-    self.vocab = load_vocab(vocab_file)
-    self.inv_vocab = {v: k for k, v in self.vocab.items()}
+  def __init__(self, vocab_file, do_lower_case=True, cache_size=0,
+               ids_cache=None):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: Path to the WordPiece vocabulary.
+      do_lower_case: Whether to lower case the input.
+      cache_size: Maximum number of words whose wordpieces are memoized in a
+        least-recently-used cache. 0 disables the cache.
+      ids_cache: (Optional) Persistent text to ids cache, such as a
+        `tokenization_cache.TokenizationCache`, consulted by `encode` and
+        `encode_batch`. It must have been created for the same vocabulary
+        and casing.
+    """
+    tokens = load_vocab_tokens(vocab_file)
+    self.vocab = dict(zip(tokens, range(len(tokens))))
+    # Ids are dense, so the inverse vocabulary is simply the token list.
+    self.inv_vocab = tokens
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
     self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
+    self.cache_size = cache_size
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.cache_evictions = 0
+    self._cache = collections.OrderedDict()
+    self.ids_cache = ids_cache
+    self._pool = None
+    self._pool_key = None
+
+  def __getstate__(self):
+    # The pool cannot be pickled, and a worker has no use for it.
+    state = self.__dict__.copy()
+    state["_pool"] = None
+    state["_pool_key"] = None
+    return state
+
   def tokenize(self, text):
+    if not self.cache_size:
+      split_tokens = []
+      for token in self.basic_tokenizer.tokenize(text):
+        for sub_token in self.wordpiece_tokenizer.tokenize(token):
+          split_tokens.append(sub_token)
+
+      return split_tokens
+
     split_tokens = []
-    for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+    for word in self.basic_tokenizer.split_words(text):
+      split_tokens.extend(self._tokenize_word_cached(word))
 
     return split_tokens
 
+  def _tokenize_word_cached(self, word):
+    """Returns the wordpieces of a single word, going through the LRU cache."""
+    cache = self._cache
+    sub_tokens = cache.get(word)
+    if sub_tokens is not None:
+      self.cache_hits += 1
+      cache.move_to_end(word)
+      return sub_tokens
+
+    self.cache_misses += 1
+    sub_tokens = []
+    for token in self.basic_tokenizer.tokenize_word(word):
+      sub_tokens.extend(self.wordpiece_tokenizer.tokenize(token))
+    sub_tokens = tuple(sub_tokens)
+
+    cache[word] = sub_tokens
+    if len(cache) > self.cache_size:
+      cache.popitem(last=False)
+      self.cache_evictions += 1
+    return sub_tokens
+
+  def clear_cache(self):
+    """Empties the word cache and resets its counters."""
+    self._cache.clear()
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.cache_evictions = 0
+
+  def close_pool(self):
+    """Stops the worker processes started by a call with `num_workers` > 1.
+
+    The pool is created on first use and reused by every later call with the
+    same `num_workers`, so call this once the batch work is done.
+    """
+    pool, key = self._pool, self._pool_key
+    self._pool = None
+    self._pool_key = None
+    # A forked child inherits the pool object but not its worker processes.
+    if pool is not None and key[0] == os.getpid():
+      pool.terminate()
+      pool.join()
+
+  def _get_pool(self, num_workers):
+    """Returns the pool of `num_workers` processes, creating it if needed."""
+    key = (os.getpid(), num_workers)
+    if self._pool_key != key:
+      self.close_pool()
+      self._pool = _create_tokenizer_pool(self, num_workers)
+      self._pool_key = key
+    return self._pool
+
+  def tokenize_batch(self, texts, num_workers=1, chunk_size=256, to_ids=False):
+    """Tokenizes a sequence of texts, optionally across a process pool.
+
+    Args:
+      texts: Iterable of texts.
+      num_workers: Number of worker processes. With 1 (the default) the texts
+        are tokenized in the calling process. Otherwise the processes are
+        kept until `close_pool`.
+      chunk_size: Number of texts sent to a worker at a time.
+      to_ids: If True, return vocabulary ids instead of wordpiece strings.
+
+    Returns:
+      A list with one list of wordpieces (or ids) per text, in input order.
+    """
+    results = []
+    for chunk in self.iter_tokenize_batch(texts, num_workers=num_workers,
+                                          chunk_size=chunk_size, to_ids=to_ids):
+      results.extend(chunk)
+    return results
+
+  def iter_tokenize_batch(self, texts, num_workers=1, chunk_size=256,
+                          to_ids=False):
+    """Same as `tokenize_batch`, but yields the results one chunk at a time.
+
+    `texts` is consumed lazily and at most `2 * num_workers` chunks are in
+    flight, so arbitrarily long iterables can be streamed in bounded memory.
+    """
+    jobs = ((None, chunk, to_ids) for chunk in _iter_chunks(texts, chunk_size))
+    for _, result in _imap_tokenize(self, jobs, num_workers):
+      yield result
+
+  def encode(self, text_a, text_b=None, max_seq_length=128):
+    """Encodes a text or a text pair into padded BERT input arrays.
+
+    The layout is the one BERT was pre-trained with:
+      (a) For sequence pairs:
+       tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+       type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
+      (b) For single sequences:
+       tokens:   [CLS] the dog is hairy . [SEP]
+       type_ids: 0     0   0   0  0     0 0
+    A pair is truncated by repeatedly dropping the last token of the longer
+    sequence, a single text by dropping its tail.
+
+    Args:
+      text_a: The first (or only) text.
+      text_b: (Optional) The second text of a pair.
+      max_seq_length: Length the arrays are padded or truncated to.
+
+    Returns:
+      A tuple (input_ids, input_mask, segment_ids) of int32 arrays of shape
+      [max_seq_length].
+    """
+    input_ids = np.zeros([max_seq_length], dtype=np.int32)
+    input_mask = np.zeros([max_seq_length], dtype=np.int32)
+    segment_ids = np.zeros([max_seq_length], dtype=np.int32)
+    ids_a = self.texts_to_ids([text_a])[0]
+    ids_b = None
+    if text_b:
+      ids_b = self.texts_to_ids([text_b])[0]
+    self._fill_encoding(ids_a, ids_b, input_ids, input_mask, segment_ids)
+    return input_ids, input_mask, segment_ids
+
+  def encode_batch(self, texts_a, texts_b=None, max_seq_length=128,
+                   input_ids=None, input_mask=None, segment_ids=None,
+                   num_workers=1):
+    """Encodes a batch of texts (or text pairs) into [N, max_seq_length] arrays.
+
+    Args:
+      texts_a: Sequence of N texts.
+      texts_b: (Optional) Sequence of N second texts of the pairs. Empty or
+        None entries are encoded as single texts.
+      max_seq_length: Length every row is padded or truncated to.
+      input_ids: (Optional) Int array of shape [N, max_seq_length] that is
+        filled in place. Allocated as int32 when not given, and likewise for
+        `input_mask` and `segment_ids`.
+      input_mask: (Optional) See `input_ids`.
+      segment_ids: (Optional) See `input_ids`.
+      num_workers: Number of tokenization processes, see `tokenize_batch`.
+
+    Returns:
+      The tuple (input_ids, input_mask, segment_ids).
+    """
+    num_texts = len(texts_a)
+    shape = [num_texts, max_seq_length]
+    if input_ids is None:
+      input_ids = np.zeros(shape, dtype=np.int32)
+    if input_mask is None:
+      input_mask = np.zeros(shape, dtype=np.int32)
+    if segment_ids is None:
+      segment_ids = np.zeros(shape, dtype=np.int32)
+
+    all_ids_a = self.texts_to_ids(texts_a, num_workers=num_workers)
+    all_ids_b = [None] * num_texts
+    pair_indices = []
+    if texts_b is not None:
+      pair_indices = [i for i, text in enumerate(texts_b) if text]
+    if pair_indices:
+      pair_ids = self.texts_to_ids([texts_b[i] for i in pair_indices],
+                                   num_workers=num_workers)
+      for i, ids_b in zip(pair_indices, pair_ids):
+        all_ids_b[i] = ids_b
+
+    for i in range(num_texts):
+      self._fill_encoding(all_ids_a[i], all_ids_b[i], input_ids[i],
+                          input_mask[i], segment_ids[i])
+    return input_ids, input_mask, segment_ids
+
+  def iter_encode(self, texts, max_seq_length=128, chunk_size=256,
+                  num_workers=1):
+    """Lazily encodes an iterable of texts.
+
+    `texts` is consumed a chunk at a time and only a bounded number of chunks
+    is in memory at once, so it can be a generator over an arbitrarily large
+    file (see `data_processors.iter_texts`).
+
+    Yields:
+      One (input_ids, input_mask, segment_ids) tuple of int32 arrays of shape
+      [max_seq_length] per text, as in `encode`.
+    """
+    for chunk, chunk_ids in self.iter_texts_to_ids(
+        texts, chunk_size=chunk_size, num_workers=num_workers):
+      input_ids, input_mask, segment_ids = (
+          np.zeros([len(chunk), max_seq_length], dtype=np.int32)
+          for _ in range(3))
+      for i, ids in enumerate(chunk_ids):
+        self._fill_encoding(ids, None, input_ids[i], input_mask[i],
+                            segment_ids[i])
+        yield input_ids[i], input_mask[i], segment_ids[i]
+
+  def texts_to_ids(self, texts, num_workers=1):
+    """Returns the wordpiece ids of each text, going through `ids_cache`.
+
+    Only the texts missing from the cache are tokenized, and their ids are
+    added to it.
+    """
+    all_ids = []
+    for _, chunk_ids in self.iter_texts_to_ids(texts, num_workers=num_workers):
+      all_ids.extend(chunk_ids)
+    return all_ids
+
+  def iter_texts_to_ids(self, texts, chunk_size=256, num_workers=1):
+    """Yields (texts, ids) for successive chunks of `texts`.
+
+    This is the streaming version of `texts_to_ids`.
+    """
+    def jobs():
+      for chunk in _iter_chunks(texts, chunk_size):
+        if self.ids_cache is None:
+          chunk_ids = [None] * len(chunk)
+        else:
+          chunk_ids = [self.ids_cache.get(text) for text in chunk]
+        missing = [i for i, ids in enumerate(chunk_ids) if ids is None]
+        yield (chunk, chunk_ids, missing), [chunk[i] for i in missing], True
+
+    for (chunk, chunk_ids, missing), missing_ids in _imap_tokenize(
+        self, jobs(), num_workers):
+      for i, ids in zip(missing, missing_ids):
+        if self.ids_cache is not None:
+          self.ids_cache.put(chunk[i], ids)
+        chunk_ids[i] = ids
+      yield chunk, chunk_ids
+
+  def _fill_encoding(self, ids_a, ids_b, input_ids, input_mask, segment_ids):
+    """Writes the encoding of one example into the given 1-D rows."""
+    # Where "type_ids" are used to indicate whether this is the first
+    # sequence or the second sequence. The embedding vectors for `type=0` and
+    # `type=1` were learned during pre-training and are added to the wordpiece
+    # embedding vector (and position vector). For classification tasks, the
+    # first vector (corresponding to [CLS]) is used as the "sentence vector".
+    max_seq_length = input_ids.shape[0]
+    if ids_b:
+      # Account for [CLS], [SEP], [SEP] with "- 3"
+      len_a, len_b = _truncated_pair_lengths(len(ids_a), len(ids_b),
+                                             max_seq_length - 3)
+    else:
+      # Account for [CLS] and [SEP] with "- 2"
+      len_a = min(len(ids_a), max_seq_length - 2)
+      len_b = 0
+
+    input_ids[:] = 0
+    segment_ids[:] = 0
+    input_ids[0] = self.vocab["[CLS]"]
+    input_ids[1:len_a + 1] = ids_a[:len_a]
+    input_ids[len_a + 1] = self.vocab["[SEP]"]
+    length = len_a + 2
+    if len_b:
+      input_ids[length:length + len_b] = ids_b[:len_b]
+      input_ids[length + len_b] = self.vocab["[SEP]"]
+      segment_ids[length:length + len_b + 1] = 1
+      length += len_b + 1
+
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real
+    # tokens are attended to.
+    input_mask[:length] = 1
+    input_mask[length:] = 0
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -168,6 +462,101 @@ class FullTokenizer(object):
     return convert_by_vocab(self.inv_vocab, ids)
 
 
+def _truncated_pair_lengths(len_a, len_b, max_length):
+  """Returns the lengths a sequence pair is truncated to.
+
+  This is a simple heuristic which will always truncate the longer sequence
+  one token at a time. This makes more sense than truncating an equal percent
+  of tokens from each, since if one sequence is very short then each token
+  that's truncated likely contains more information than a longer sequence.
+  """
+  while len_a + len_b > max_length:
+    if len_a > len_b:
+      len_a -= 1
+    else:
+      len_b -= 1
+  return len_a, len_b
+
+
+# Tokenizer used by the processes of a pool created by `_create_tokenizer_pool`.
+_worker_tokenizer = None
+
+
+def _init_tokenizer_worker(tokenizer):
+  global _worker_tokenizer
+  _worker_tokenizer = tokenizer
+
+
+def _tokenize_chunk(texts, to_ids):
+  return _tokenize_texts(_worker_tokenizer, texts, to_ids)
+
+
+def _tokenize_texts(tokenizer, texts, to_ids):
+  if to_ids:
+    return [tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+            for text in texts]
+  return [tokenizer.tokenize(text) for text in texts]
+
+
+def _imap_tokenize(tokenizer, jobs, num_workers):
+  """Runs `_tokenize_texts` on each job, optionally in a process pool.
+
+  Args:
+    tokenizer: The `FullTokenizer` to use.
+    jobs: Iterable of (context, texts, to_ids) tuples. It is consumed lazily
+      and at most `2 * num_workers` jobs are in flight.
+    num_workers: Number of worker processes, 1 to work in this process. The
+      pool is the one `tokenizer` keeps until its `close_pool`.
+
+  Yields:
+    (context, result) for each job, in order.
+  """
+  if num_workers <= 1:
+    for context, texts, to_ids in jobs:
+      yield context, _tokenize_texts(tokenizer, texts, to_ids)
+    return
+
+  pool = None
+  pending = collections.deque()
+  for context, texts, to_ids in jobs:
+    # Fetched here, so that no pool is created for an empty job list.
+    if pool is None:
+      pool = tokenizer._get_pool(num_workers)
+    pending.append(
+        (context, pool.apply_async(_tokenize_chunk, (texts, to_ids))))
+    if len(pending) >= 2 * num_workers:
+      context, result = pending.popleft()
+      yield context, result.get()
+  while pending:
+    context, result = pending.popleft()
+    yield context, result.get()
+
+
+def _create_tokenizer_pool(tokenizer, num_workers):
+  """Creates a process pool whose workers hold a copy of `tokenizer`.
+
+  Where available the workers are forked, so the vocabulary is inherited
+  copy-on-write instead of being pickled to every process.
+  """
+  if "fork" in multiprocessing.get_all_start_methods():
+    context = multiprocessing.get_context("fork")
+  else:
+    context = multiprocessing.get_context()
+  return context.Pool(processes=num_workers,
+                      initializer=_init_tokenizer_worker,
+                      initargs=(tokenizer,))
+
+
+def _iter_chunks(iterable, chunk_size):
+  """Yields successive lists of at most `chunk_size` items of `iterable`."""
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
@@ -182,46 +571,87 @@ class BasicTokenizer(object):
   def tokenize(self, text):
     """Tokenizes a piece of text."""
     text = convert_to_unicode(text)
-    text = self._clean_text(text)
+    if _is_ascii(text):
+      return self._tokenize_ascii(text)
+    return self._tokenize_unicode(text)
 
-    # This was added on November 1st, 2018 for the multilingual and Chinese
-    # models. This is also applied to the English models now, but it doesn't
-    # matter since the English models were not trained on any Chinese data
-    # and generally don't have any Chinese data in them (there are Chinese
-    # characters in the vocabulary because Wikipedia does have some Chinese
-    # words in the English Wikipedia.).
-    text = self._tokenize_chinese_chars(text)
+  def _tokenize_ascii(self, text):
+    """Tokenizes a piece of pure ASCII text.
 
-    orig_tokens = whitespace_tokenize(text)
-    split_tokens = []
-    for token in orig_tokens:
-      if self.do_lower_case:
-        token = token.lower()
-        token = self._run_strip_accents(token)
-      split_tokens.extend(self._run_split_on_punc(token))
+    ASCII text has no accents, no CJK characters and nothing outside the BMP,
+    so after the table-driven cleanup the whole text is lower cased and split
+    into words and punctuation by a single regex.
+    """
+    text = text.translate(_ASCII_CLEAN_MAP)
+    if self.do_lower_case:
+      text = text.lower()
+    return _ASCII_TOKEN_RE.findall(text)
 
-    output_tokens = whitespace_tokenize(" ".join(split_tokens))
+  def _tokenize_unicode(self, text):
+    """Tokenizes a piece of text that may contain any character."""
+    output_tokens = []
+    for token in self.split_words(text):
+      output_tokens.extend(self.tokenize_word(token))
     return output_tokens
 
+  def split_words(self, text):
+    """Cleans `text` and splits it into whitespace-delimited words.
+
+    Invalid character removal, whitespace cleanup and the spacing of CJK
+    characters are fused into a single `str.translate` pass driven by the
+    precomputed character table, or by the ASCII one for pure ASCII text. Every word returned here is processed
+    independently of its neighbours by `tokenize_word`, which makes the words
+    suitable as cache keys.
+    """
+    text = convert_to_unicode(text)
+    if _is_ascii(text):
+      return text.translate(_ASCII_CLEAN_MAP).split()
+
+    # Characters outside the BMP are not in the table, so they are rewritten
+    # one by one before the table-driven pass.
+    if _ASTRAL_CHAR_RE.search(text):
+      text = _ASTRAL_CHAR_RE.sub(_clean_astral_char, text)
+
+    # Spacing out CJK characters was added on November 1st, 2018 for the
+    # multilingual and Chinese models. This is also applied to the English
+    # models now, but it doesn't matter since the English models were not
+    # trained on any Chinese data and generally don't have any Chinese data in
+    # them (there are Chinese characters in the vocabulary because Wikipedia
+    # does have some Chinese words in the English Wikipedia.).
+    return text.translate(_get_char_tables().clean_map).split()
+
+  def tokenize_word(self, token):
+    """Lower cases, strips accents and splits punctuation of a single word."""
+    if _is_ascii(token):
+      if self.do_lower_case:
+        token = token.lower()
+      return _ASCII_TOKEN_RE.findall(token)
+    if self.do_lower_case:
+      token = token.lower()
+      token = self._run_strip_accents(token)
+    return self._run_split_on_punc(token)
+
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
-    output = []
-    for char in text:
-      cat = unicodedata.category(char)
-      if cat == "Mn":
-        continue
-      output.append(char)
-    return "".join(output)
+    text = text.translate(_get_char_tables().accent_map)
+    if _ASTRAL_CHAR_RE.search(text):
+      text = "".join(
+          char for char in text if unicodedata.category(char) != "Mn")
+    return text
 
   def _run_split_on_punc(self, text):
     """Splits punctuation on a piece of text."""
-    chars = list(text)
-    i = 0
-    start_new_word = True
+    if _ASTRAL_CHAR_RE.search(text):
+      return self._run_split_on_punc_slow(text)
+    return [piece for piece in _get_char_tables().punctuation_re.split(text)
+            if piece]
+
+  def _run_split_on_punc_slow(self, text):
+    """Character by character version of `_run_split_on_punc`."""
     output = []
-    while i < len(chars):
-      char = chars[i]
+    start_new_word = True
+    for char in text:
       if _is_punctuation(char):
         output.append([char])
         start_new_word = True
@@ -230,58 +660,9 @@ class BasicTokenizer(object):
           output.append([])
         start_new_word = False
         output[-1].append(char)
-      i += 1
 
     return ["".join(x) for x in output]
 
-  def _tokenize_chinese_chars(self, text):
-    """Adds whitespace around any CJK character."""
-    output = []
-    for char in text:
-      cp = ord(char)
-      if self._is_chinese_char(cp):
-        output.append(" ")
-        output.append(char)
-        output.append(" ")
-      else:
-        output.append(char)
-    return "".join(output)
-
-  def _is_chinese_char(self, cp):
-    """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
-
-    return False
-
-  def _clean_text(self, text):
-    """Performs invalid character removal and whitespace cleanup on text."""
-    output = []
-    for char in text:
-      cp = ord(char)
-      if cp == 0 or cp == 0xfffd or _is_control(char):
-        continue
-      if _is_whitespace(char):
-        output.append(" ")
-      else:
-        output.append(char)
-    return "".join(output)
-
 
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
@@ -290,6 +671,16 @@ class WordpieceTokenizer(object):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    # Continuation pieces are kept without their "##" prefix, so that probing
+    # for one does not build "##" + candidate for every candidate length.
+    self._suffixes = set()
+    self._max_len = 0
+    self._max_suffix_len = 0
+    for token in vocab:
+      if token.startswith("##") and len(token) > 2:
+        self._suffixes.add(token[2:])
+        self._max_suffix_len = max(self._max_suffix_len, len(token) - 2)
+      self._max_len = max(self._max_len, len(token))
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -313,37 +704,71 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
+      if len(token) > self.max_input_chars_per_word:
         output_tokens.append(self.unk_token)
         continue
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
-
-      if is_bad:
+      sub_tokens = self._tokenize_word(token)
+      if sub_tokens is None:
         output_tokens.append(self.unk_token)
       else:
         output_tokens.extend(sub_tokens)
     return output_tokens
 
+  def _tokenize_word(self, token):
+    """Splits a single word into word pieces, or returns None if impossible.
+
+    Each piece is the longest vocabulary entry starting at the current
+    position, found by probing `vocab` from the longest candidate down. No
+    piece is longer than the longest vocabulary entry, so the probes start
+    there rather than at the end of the word, which keeps long words linear in
+    their length. The result is the same greedy longest-match-first
+    segmentation.
+    """
+    if token in self.vocab:
+      return [token]
+    sub_tokens = []
+    start = 0
+    num_chars = len(token)
+    pieces = self.vocab
+    max_len = self._max_len
+    prefix = ""
+    while start < num_chars:
+      end = min(num_chars, start + max_len)
+      while end > start and token[start:end] not in pieces:
+        end -= 1
+      if end == start:
+        return None
+      sub_tokens.append(prefix + token[start:end])
+      start = end
+      pieces = self._suffixes
+      max_len = self._max_suffix_len
+      prefix = "##"
+    return sub_tokens
+
+
+def _is_chinese_char(cp):
+  """Checks whether CP is the codepoint of a CJK character."""
+  # This defines a "chinese character" as anything in the CJK Unicode block:
+  #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+  #
+  # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+  # despite its name. The modern Korean Hangul alphabet is a different block,
+  # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+  # space-separated words, so they are not treated specially and handled
+  # like the all of the other languages.
+  if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+      (cp >= 0x3400 and cp <= 0x4DBF) or  #
+      (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+      (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+      (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+      (cp >= 0x2B820 and cp <= 0x2CEAF) or
+      (cp >= 0xF900 and cp <= 0xFAFF) or  #
+      (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+    return True
+
+  return False
+
 
 def _is_whitespace(char):
   """Checks whether `chars` is a whitespace character."""
@@ -383,3 +808,123 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+# Character classes stored in `_CharTables.classes`.
+_CHAR_INVALID = 1
+_CHAR_WHITESPACE = 2
+_CHAR_PUNCTUATION = 4
+_CHAR_CHINESE = 8
+_CHAR_NONSPACING_MARK = 16
+
+_BMP_SIZE = 0x10000
+
+_ASTRAL_CHAR_RE = re.compile(u"[\U00010000-\U0010FFFF]")
+
+# Words and single punctuation characters of cleaned ASCII text. Once control
+# characters are removed and whitespace is normalized to " ", every ASCII
+# character that is not a letter, a digit or a space is punctuation.
+_ASCII_TOKEN_RE = re.compile(r"[A-Za-z0-9]+|[^A-Za-z0-9 ]")
+
+
+def _is_ascii_slow(text):
+  try:
+    text.encode("ascii")
+  except UnicodeError:
+    return False
+  return True
+
+
+# `str.isascii` only exists from Python 3.7 on.
+_is_ascii = getattr(six.text_type, "isascii", _is_ascii_slow)
+
+
+def _classify_char(char):
+  """Returns the `_CHAR_*` flags of a single character."""
+  cp = ord(char)
+  flags = 0
+  if cp == 0 or cp == 0xfffd or _is_control(char):
+    flags |= _CHAR_INVALID
+  # `whitespace_tokenize` splits on everything `str.split` considers
+  # whitespace, which is a superset of `_is_whitespace`.
+  if _is_whitespace(char) or char.isspace():
+    flags |= _CHAR_WHITESPACE
+  if _is_punctuation(char):
+    flags |= _CHAR_PUNCTUATION
+  if _is_chinese_char(cp):
+    flags |= _CHAR_CHINESE
+  if unicodedata.category(char) == "Mn":
+    flags |= _CHAR_NONSPACING_MARK
+  return flags
+
+
+def _clean_char(char, flags):
+  """Returns what `BasicTokenizer.split_words` replaces `char` with."""
+  if flags & _CHAR_INVALID:
+    return u""
+  if flags & _CHAR_WHITESPACE:
+    return u" "
+  if flags & _CHAR_CHINESE:
+    return u" " + char + u" "
+  return char
+
+
+def _build_ascii_clean_map():
+  """Returns the part of `_CharTables.clean_map` covering ASCII."""
+  clean_map = {}
+  for cp in range(128):
+    char = six.unichr(cp)
+    cleaned = _clean_char(char, _classify_char(char))
+    if cleaned != char:
+      clean_map[cp] = cleaned
+  return clean_map
+
+
+# All `BasicTokenizer` needs for pure ASCII text. It is cheap enough to build
+# at import, so tokenizing ASCII text never builds the full `_CharTables`.
+_ASCII_CLEAN_MAP = _build_ascii_clean_map()
+
+
+def _clean_astral_char(match):
+  char = match.group(0)
+  return _clean_char(char, _classify_char(char))
+
+
+class _CharTables(object):
+  """Character classes of every BMP codepoint, computed once on first use.
+
+  Besides the raw per-codepoint flags this holds the derived structures used
+  by `BasicTokenizer`: a `str.translate` map for text cleanup and CJK spacing,
+  a `str.translate` map deleting non-spacing marks and a regex matching any
+  punctuation character.
+  """
+
+  def __init__(self):
+    self.classes = bytearray(_BMP_SIZE)
+    self.clean_map = {}
+    self.accent_map = {}
+    punctuation = []
+    for cp in range(_BMP_SIZE):
+      char = six.unichr(cp)
+      flags = _classify_char(char)
+      self.classes[cp] = flags
+      cleaned = _clean_char(char, flags)
+      if cleaned != char:
+        self.clean_map[cp] = cleaned
+      if flags & _CHAR_NONSPACING_MARK:
+        self.accent_map[cp] = None
+      if flags & _CHAR_PUNCTUATION:
+        punctuation.append(char)
+    self.punctuation_re = re.compile(
+        u"([%s])" % u"".join(re.escape(char) for char in punctuation))
+
+
+_char_tables = None
+
+
+def _get_char_tables():
+  """Returns the shared `_CharTables`, building them on first use."""
+  global _char_tables
+  if _char_tables is None:
+    _char_tables = _CharTables()
+  return _char_tables
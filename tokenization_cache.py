@@ -0,0 +1,165 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Copyright Tor Vergata, University of Rome. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+#
+# Persistent cache of tokenized texts, shared across runs
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import io
+import os
+import re
+import numpy as np
+import tensorflow as tf
+import tokenization
+
+# Bump when the tokenizer output changes, so that stale caches are ignored.
+CACHE_FORMAT_VERSION = 2
+
+# Keys are stored as hex digests: fixed-size numpy byte strings drop trailing
+# NUL bytes, which raw digests may end with.
+_KEY_SIZE = 2 * hashlib.sha1().digest_size
+
+# Runs of the whitespace characters that both `BasicTokenizer` paths turn into
+# a single separator.
+_ASCII_WHITESPACE_RE = re.compile(r"[ \t\n\r]+")
+
+
+class TokenizationCache(object):
+  """Content-addressed on-disk cache mapping texts to wordpiece ids.
+
+  Entries are keyed by the SHA-1 of the UTF-8 encoded text, normalized by
+  `normalize_text`, and live in a file named after a hash of the vocabulary
+  file content and `do_lower_case`, so a cache directory can safely be shared
+  by runs with different tokenizers.
+  The file is a columnar .npz holding the sorted keys, the offsets of every
+  entry and all the ids concatenated into one int32 array.
+
+  Pass it as `ids_cache` to `tokenization.FullTokenizer` and call `save` once
+  new texts have been encoded.
+  """
+
+  def __init__(self, cache_dir, vocab_file, do_lower_case):
+    hasher = hashlib.sha1()
+    with tf.gfile.GFile(vocab_file, "rb") as reader:
+      hasher.update(reader.read())
+    hasher.update(("|lower=%s|v%d" % (bool(do_lower_case),
+                                      CACHE_FORMAT_VERSION)).encode("utf-8"))
+    self.cache_file = os.path.join(cache_dir,
+                                   "tokens-%s.npz" % hasher.hexdigest()[:16])
+    self.do_lower_case = do_lower_case
+
+    self._keys = np.zeros([0], dtype="S%d" % _KEY_SIZE)
+    self._offsets = np.zeros([1], dtype=np.int64)
+    self._ids = np.zeros([0], dtype=np.int32)
+    self._new_entries = {}
+    self.hits = 0
+    self.misses = 0
+
+    if tf.gfile.Exists(self.cache_file):
+      with tf.gfile.GFile(self.cache_file, "rb") as reader:
+        arrays = np.load(io.BytesIO(reader.read()))
+        self._keys = arrays["keys"]
+        self._offsets = arrays["offsets"]
+        self._ids = arrays["ids"]
+    tf.logging.info("Tokenization cache %s holds %d texts", self.cache_file,
+                    len(self._keys))
+
+  def __len__(self):
+    return len(self._keys) + len(self._new_entries)
+
+  def normalize_text(self, text):
+    """Returns the form of `text` the cache keys entries on.
+
+    Runs of spaces, tabs and newlines are collapsed and stripped, and pure
+    ASCII text is lower cased with `do_lower_case`: the tokenizer output
+    does not depend on either. Other variations it ignores, such as the case
+    of non-ASCII letters, Unicode whitespace or accents, are kept, so texts
+    differing only in those have separate entries.
+    """
+    text = _ASCII_WHITESPACE_RE.sub(
+        u" ", tokenization.convert_to_unicode(text)).strip(u" ")
+    if self.do_lower_case and tokenization._is_ascii(text):
+      text = text.lower()
+    return text
+
+  def _key(self, text):
+    return hashlib.sha1(self.normalize_text(text).encode(
+        "utf-8")).hexdigest().encode("ascii")
+
+  def get(self, text):
+    """Returns the cached ids of `text` as a list, or None."""
+    key = self._key(text)
+    ids = self._new_entries.get(key)
+    if ids is None:
+      index = np.searchsorted(self._keys, key)
+      if index < len(self._keys) and self._keys[index] == key:
+        ids = self._ids[self._offsets[index]:self._offsets[index + 1]].tolist()
+    if ids is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return ids
+
+  def put(self, text, ids):
+    """Adds the ids of `text`, to be written by the next `save`."""
+    self._new_entries[self._key(text)] = list(ids)
+
+  def take_new_entries(self):
+    """Returns and forgets the entries added since the last `save`.
+
+    They can be handed to `add_entries` of another instance, e.g. by a worker
+    process whose copy of the cache would otherwise be lost.
+    """
+    entries = self._new_entries
+    self._new_entries = {}
+    return entries
+
+  def add_entries(self, entries):
+    """Adds entries returned by `take_new_entries`, to be written by `save`."""
+    self._new_entries.update(entries)
+
+  def save(self):
+    """Merges the new entries into the cache file. No-op if there are none."""
+    if not self._new_entries:
+      return
+
+    new_keys = sorted(self._new_entries)
+    new_lengths = [len(self._new_entries[key]) for key in new_keys]
+    new_ids = np.zeros([sum(new_lengths)], dtype=np.int32)
+    position = 0
+    for key, length in zip(new_keys, new_lengths):
+      new_ids[position:position + length] = self._new_entries[key]
+      position += length
+
+    keys = np.concatenate(
+        [self._keys, np.array(new_keys, dtype=self._keys.dtype)])
+    lengths = np.concatenate([np.diff(self._offsets), new_lengths])
+    ids = np.concatenate([self._ids, new_ids])
+    starts = np.concatenate([self._offsets[:-1],
+                             len(self._ids) + np.cumsum([0] + new_lengths[:-1])])
+
+    order = np.argsort(keys, kind="mergesort")
+    self._keys = keys[order]
+    lengths = lengths[order]
+    self._offsets = np.zeros([len(order) + 1], dtype=np.int64)
+    np.cumsum(lengths, out=self._offsets[1:])
+    # Gathers the ids of every entry in key order with a single fancy index.
+    gather = (np.repeat(starts[order] - self._offsets[:-1], lengths) +
+              np.arange(self._offsets[-1]))
+    self._ids = ids[gather]
+    self._new_entries = {}
+
+    tf.gfile.MakeDirs(os.path.dirname(self.cache_file) or ".")
+    buffer = io.BytesIO()
+    np.savez(buffer, keys=self._keys, offsets=self._offsets, ids=self._ids)
+    temp_file = self.cache_file + ".tmp"
+    with tf.gfile.GFile(temp_file, "wb") as writer:
+      writer.write(buffer.getvalue())
+    tf.gfile.Rename(temp_file, self.cache_file, overwrite=True)
+    tf.logging.info("Saved %d tokenized texts to %s", len(self._keys),
+                    self.cache_file)
+